@@ -1,12 +1,30 @@
 #!/env/Python
 
-import os,sys,tempfile,subprocess,shutil,configparser,warnings
+import os,re,sys,tempfile,subprocess,shutil,configparser,warnings,argparse,hashlib,ssl,json
+import asyncio,time,threading,socket,concurrent.futures,urllib.request,urllib.error
+import io,gzip,bz2,lzma,tarfile,zipfile,shlex
 from urllib import parse
 from enum import Enum,unique
 from collections import namedtuple
 from dataclasses import dataclass
 
 ENTRYPOINT_SCRIPT_PATH = "/usr/sbin/forever"
+DOWNLOAD_CACHE_PATH = "/var/cache/langs/archives"
+PREFETCH_PATH = "/opt/langs-prefetch"
+CCACHE_PATH = "/var/cache/langs/ccache"
+YUM_CACHE_PATH = "/var/cache/yum"
+ARTIFACT_CACHE_PATH = "/var/cache/langs/artifacts"
+DEPENDENCY_CACHE_PATH = "/var/cache/langs/dependencies"
+PROFILE_PATH = "/var/lib/langs/build-profile.jsonl"
+ENVIRONMENT_PATH = "/etc/profile.d/langs.sh"
+LD_SO_CONF_PATH = "/etc/ld.so.conf.d/langs.conf"
+SIZE_REPORT_PATH = "/var/lib/langs/size-report.jsonl"
+INPUTS_HASH_LABEL = "langs.inputs.hash"
+# 输入哈希的版本：2起编译脚本中任一步骤失败时构建失败，之前的镜像即使构建成功也可能包含失败的步骤，不再复用
+INPUTS_HASH_VERSION = 2
+VOLUMES_LABEL = "langs.volumes"
+SERVICES_PATH = "/etc/langs/services.d"
+MIRROR_RANKING_PATH = os.path.expanduser("~/.cache/langs/mirrors.json")
 
 @unique
 class CompressionDefs(Enum):
@@ -15,8 +33,11 @@ class CompressionDefs(Enum):
     BZ = ".tar.bz"
     BZ2 = ".tar.bz2"
     Z = ".tar.Z"
+    ZST = ".tar.zst"
     ZIP = ".zip"
     RPM = ".rpm"
+    # 未压缩的tar放在最后，按后缀匹配时不影响其他格式
+    TAR = ".tar"
 
 @unique
 class GroupDefs(Enum):
@@ -38,6 +59,33 @@ class InstallDefs(Enum):
     rpm = 4
     custom = 5
 
+@unique
+class YumBatchDefs(Enum):
+    group = 1
+    all = 2
+
+@unique
+class StepDefs(Enum):
+    phase = 1
+    group = 2
+    package = 3
+    yum = 4
+    after_group = 5
+
+@unique
+class EntrypointDefs(Enum):
+    systemd = ENTRYPOINT_SCRIPT_PATH
+    supervisor = "/usr/sbin/langs-init"
+
+@unique
+class MirrorDefs(Enum):
+    yum = 1
+    pypi = 2
+    go = 3
+    rustup = 4
+    maven = 5
+    npm = 6
+
 @unique
 class OperateSystemDef(Enum):
     centos = "7"
@@ -101,6 +149,7 @@ group = {GroupDefs.cpp.name}
 install = {InstallDefs.http.name}
 version = 3.15.2
 url = https://github.com/Kitware/CMake/releases/download/v{{version}}/cmake-{{version}}-Linux-x86_64{CompressionDefs.GZ.value}
+slim = ./doc ./man
 
 [zlib]
 group = {GroupDefs.python.name}
@@ -141,13 +190,22 @@ url = {{name}}-devel
 group = {GroupDefs.python.name}
 install = {InstallDefs.http.name}
 version = 3.8.2
+# configure = --enable-optimizations --with-lto
+requires = gcc make zlib openssl ncurses sqlite readline tk libffi
 url = https://www.python.org/ftp/python/{{version}}/Python-{{version}}{CompressionDefs.XZ.value}
+preload = wheel pipenv
+volumes = /root/.cache/pip
+slim = lib/python*/test lib/python*/*/test lib/python*/*/tests idle_test __pycache__ *.a share/man
+paths = /etc/pip.conf
 
 [node]
 group = {GroupDefs.js.name}
 install = {InstallDefs.http.name}
 version = 10.1.0
 url = https://nodejs.org/dist/v{{version}}/node-v{{version}}-linux-x64{CompressionDefs.XZ.value}
+# preload = typescript@3.9.5
+volumes = /root/.npm
+slim = share/doc share/man CHANGELOG.md README.md
 
 [openjdk]
 group = {GroupDefs.java.name}
@@ -158,17 +216,40 @@ url = java-{{version}}-{{name}} java-{{version}}-{{name}}-devel
 [maven]
 group = {GroupDefs.java.name}
 install = {InstallDefs.yum.name}
+# preload = org.apache.maven.plugins:maven-compiler-plugin:3.8.1 org.apache.maven.plugins:maven-surefire-plugin:2.22.2
+paths = /root/.m2
+volumes = /root/.m2/repository
 
 [golang]
 group = {GroupDefs.golang.name}
 install = {InstallDefs.http.name}
 version = 1.14
 url = https://mirrors.ustc.edu.cn/golang/go{{version}}.linux-amd64{CompressionDefs.GZ.value}
+# preload = golang.org/x/text@v0.3.3 github.com/pkg/errors@v0.9.1
+paths = /root/gowork
+volumes = /root/gowork/pkg/mod /root/.cache/go-build
+slim = ./test ./doc ./api ./misc pkg/bootstrap pkg/obj testdata *_test.go
+
+[rustup-init]
+group = {GroupDefs.rust.name}
+install = {InstallDefs.http.name}
+version = 1.21.1
+url = https://static.rust-lang.org/rustup/archive/{{version}}/x86_64-unknown-linux-gnu/rustup-init
+paths = /root/.cargo /root/.rustup
 
 [rust]
 group = {GroupDefs.rust.name}
-install = {InstallDefs.custom.name}
-version = 
+install = {InstallDefs.http.name}
+version = 1.44.1
+requires = rustup-init
+# cargo使用cc链接，多阶段构建的最终镜像中也需要安装
+runtime_requires = gcc
+url = https://static.rust-lang.org/dist/rust-{{version}}-x86_64-unknown-linux-gnu{CompressionDefs.GZ.value}
+# registry = /opt/crates.io-index
+# registry = crates.io-index
+slim = share/doc share/man
+paths = /root/.cargo /root/.rustup
+volumes = /root/.cargo/registry /root/.cargo/git
 
 [fvs]
 group = {GroupDefs.tool.name}
@@ -184,11 +265,190 @@ class Pkg:
     install : str
     group : str
     url : str
+    sha256 : str = None
+    configure : str = None
+    requires : str = None
+    runtime_requires : str = None
+    slim : str = None
+    paths : str = None
+    registry : str = None
+    preload : str = None
+    volumes : str = None
+
+# 候选镜像：probe为测速时下载的小文件，default表示未测速时使用的镜像
+# YUM镜像的url为.repo文件时直接下载，否则作为baseurl替换官方repo文件中的地址
+MIRROR_INFO_STR = f'''
+[aliyun]
+kind = {MirrorDefs.yum.name}
+default = yes
+url = https://mirrors.aliyun.com/repo/Centos-{{centos}}.repo
+probe = https://mirrors.aliyun.com/centos/{{centos}}/os/x86_64/repodata/repomd.xml
+exclude = mirrors.cloud.aliyuncs.com mirrors.aliyuncs.com
+
+[netease]
+kind = {MirrorDefs.yum.name}
+default = yes
+url = https://mirrors.163.com/.help/CentOS{{centos}}-Base-163.repo
+probe = https://mirrors.163.com/centos/{{centos}}/os/x86_64/repodata/repomd.xml
+
+[tuna]
+kind = {MirrorDefs.yum.name}
+url = https://mirrors.tuna.tsinghua.edu.cn/centos
+probe = https://mirrors.tuna.tsinghua.edu.cn/centos/{{centos}}/os/x86_64/repodata/repomd.xml
+
+[ustc]
+kind = {MirrorDefs.yum.name}
+url = https://mirrors.ustc.edu.cn/centos
+probe = https://mirrors.ustc.edu.cn/centos/{{centos}}/os/x86_64/repodata/repomd.xml
+
+[pypi-aliyun]
+kind = {MirrorDefs.pypi.name}
+default = yes
+url = https://mirrors.aliyun.com/pypi/simple/
+probe = https://mirrors.aliyun.com/pypi/simple/pip/
+
+[pypi-tuna]
+kind = {MirrorDefs.pypi.name}
+url = https://pypi.tuna.tsinghua.edu.cn/simple/
+probe = https://pypi.tuna.tsinghua.edu.cn/simple/pip/
+
+[pypi]
+kind = {MirrorDefs.pypi.name}
+url = https://pypi.org/simple/
+probe = https://pypi.org/simple/pip/
+
+[goproxy-cn]
+kind = {MirrorDefs.go.name}
+url = https://goproxy.cn
+probe = https://goproxy.cn/golang.org/x/text/@v/list
+
+[goproxy-aliyun]
+kind = {MirrorDefs.go.name}
+url = https://mirrors.aliyun.com/goproxy
+probe = https://mirrors.aliyun.com/goproxy/golang.org/x/text/@v/list
+
+[goproxy]
+kind = {MirrorDefs.go.name}
+url = https://proxy.golang.org
+probe = https://proxy.golang.org/golang.org/x/text/@v/list
+
+[maven-aliyun]
+kind = {MirrorDefs.maven.name}
+default = yes
+url = https://maven.aliyun.com/repository/public
+probe = https://maven.aliyun.com/repository/public/junit/junit/maven-metadata.xml
+
+[maven-huaweicloud]
+kind = {MirrorDefs.maven.name}
+url = https://repo.huaweicloud.com/repository/maven
+probe = https://repo.huaweicloud.com/repository/maven/junit/junit/maven-metadata.xml
+
+[maven-central]
+kind = {MirrorDefs.maven.name}
+url = https://repo.maven.apache.org/maven2
+probe = https://repo.maven.apache.org/maven2/junit/junit/maven-metadata.xml
+
+[npm-npmmirror]
+kind = {MirrorDefs.npm.name}
+default = yes
+url = https://registry.npmmirror.com
+probe = https://registry.npmmirror.com/npm/latest
+
+[npm-tencent]
+kind = {MirrorDefs.npm.name}
+url = https://mirrors.cloud.tencent.com/npm
+probe = https://mirrors.cloud.tencent.com/npm/npm/latest
+
+[npm]
+kind = {MirrorDefs.npm.name}
+url = https://registry.npmjs.org
+probe = https://registry.npmjs.org/npm/latest
+
+[rustup-sjtug]
+kind = {MirrorDefs.rustup.name}
+default = yes
+url = https://mirrors.sjtug.sjtu.edu.cn/rust-static
+probe = https://mirrors.sjtug.sjtu.edu.cn/rust-static/rustup/release-stable.toml
+registry = git://mirrors.sjtug.sjtu.edu.cn/crates.io-index
+
+[rustup-ustc]
+kind = {MirrorDefs.rustup.name}
+url = https://mirrors.ustc.edu.cn/rust-static
+probe = https://mirrors.ustc.edu.cn/rust-static/rustup/release-stable.toml
+registry = https://mirrors.ustc.edu.cn/crates.io-index
+
+[rustup]
+kind = {MirrorDefs.rustup.name}
+url = https://static.rust-lang.org
+probe = https://static.rust-lang.org/rustup/release-stable.toml
+'''
+
+@dataclass
+class Mirror:
+    name : str
+    kind : str
+    url : str
+    probe : str = None
+    default : str = None
+    exclude : str = None
+    registry : str = None
+
+    def get_probe_url(self):
+        return (self.probe or self.url).format(centos = OperateSystemDef.centos.value)
+
+def load_mirrors(mirrors_file = None):
+    '''读取候选镜像，指定文件时使用文件中的镜像替换内置的候选镜像
+    '''
+    cp = configparser.ConfigParser()
+    if mirrors_file:
+        with open(mirrors_file, 'r', encoding = 'utf-8') as f:
+            cp.read_file(f)
+    else:
+        cp.read_string(MIRROR_INFO_STR)
+
+    mirrors = []
+    for section in cp.sections():
+        d = dict(cp.items(section))
+        if d.get('kind') not in MirrorDefs.__members__:
+            raise ValueError(f'Unknown mirror kind of {section}: {d.get("kind")}')
+        mirrors.append(Mirror(name = section, **d))
+    return mirrors
+
+def get_default_mirrors(mirrors):
+    '''未测速时每种类型使用的镜像：候选镜像中标记了default的镜像
+    '''
+    return { kind : [ m for m in mirrors if m.kind == kind and m.default ] for kind in MirrorDefs.__members__ }
+
+# stage为多阶段构建时脚本所在的阶段，其他模式为None
+ScriptFragment = namedtuple('ScriptFragment', ['name', 'group', 'content', 'stage'], defaults = [None])
 
 class ShCoder(object):
-    def __init__(self, internal_hub = None, *groups):
+    def __init__(self, internal_hub = None, *groups, layered = False, download_cache = None, download_cache_size = 2048, yum_batch = None, jobs = None, ccache = None, ccache_size = 5, artifact_cache = None, artifact_cache_size = 4096, stream = False, verbose = False, parallel = None, yum_cache = None, mirrors = None, fetch_retries = 5, slim = False, multistage = False, entrypoint = EntrypointDefs.systemd.name, ldconfig = False, dependency_cache = None, declare_volumes = False, locales = None):
         self.__internal_hub = internal_hub
         self.__groups = groups
+        self.__layered = layered
+        self.__download_cache = download_cache
+        self.__download_cache_size = download_cache_size
+        self.__prefetched = {}
+        self.__yum_batch = yum_batch
+        self.__jobs = jobs
+        self.__ccache = ccache
+        self.__ccache_size = ccache_size
+        self.__artifact_cache = artifact_cache
+        self.__artifact_cache_size = artifact_cache_size
+        self.__stream = stream
+        self.__verbose = verbose
+        self.__parallel = parallel
+        self.__yum_cache = yum_cache
+        self.__mirrors = mirrors
+        self.__fetch_retries = fetch_retries
+        self.__slim = slim
+        self.__multistage = multistage
+        self.__entrypoint = EntrypointDefs[entrypoint or EntrypointDefs.systemd.name]
+        self.__ldconfig = ldconfig
+        self.__dependency_cache = dependency_cache
+        self.__declare_volumes = declare_volumes
+        self.__locales = locales or [ 'zh_CN.UTF-8', 'en_US.UTF-8' ]
         self.__build_root = '/opt/langs-build'
         self.__cp = configparser.ConfigParser()
 
@@ -211,13 +471,90 @@ class ShCoder(object):
     def archive_home(self):
         return f'{self.__build_root}/.archives'
 
+    @property
+    def download_cache(self):
+        '''下载的软件包压缩文件的缓存目录
+        '''
+        return self.__download_cache
+
+    @property
+    def multistage(self):
+        '''多阶段构建：公共的基础阶段，每个语言组一个编译阶段，最终镜像只复制所选语言的安装目录
+        '''
+        return self.__multistage
+
+    @property
+    def yum_cache(self):
+        '''YUM下载的RPM包和仓库元数据的缓存目录
+        '''
+        return self.__yum_cache
+
+    @property
+    def ccache(self):
+        '''ccache的编译结果目录
+        '''
+        return self.__ccache
+
+    @property
+    def artifact_cache(self):
+        '''按源码和编译选项保存的安装目录归档
+        '''
+        return self.__artifact_cache
+
+    @property
+    def dependency_cache(self):
+        '''wheel、Maven仓库、Go模块和npm包的缓存目录
+        '''
+        return self.__dependency_cache
+
+    def get_cache_key(self, pkg):
+        '''下载缓存的键：有校验和时按内容寻址，否则按原始URL寻址
+        '''
+        if pkg.sha256:
+            return f'sha256-{pkg.sha256.lower()}'
+        u = pkg.url.format(name = pkg.name, version = pkg.version)
+        return f'url-{hashlib.sha256(u.encode("utf-8")).hexdigest()}'
+
+    def get_run_mounts(self, groups = None):
+        '''Dockerfile中RUN步骤使用的挂载参数，groups为该步骤安装的组，默认为全部组
+        '''
+        groups = self.__groups if groups is None else groups
+
+        mounts = []
+        if self.download_cache:
+            mounts.append(f'--mount=type=cache,id={self.name}-archives,target={self.download_cache},sharing=locked')
+        if self.yum_cache:
+            mounts.append(f'--mount=type=cache,id={self.name}-yum,target={self.yum_cache},sharing=locked')
+        if self.ccache:
+            mounts.append(f'--mount=type=cache,id={self.name}-ccache,target={self.ccache}')
+        if self.artifact_cache:
+            mounts.append(f'--mount=type=cache,id={self.name}-artifacts,target={self.artifact_cache},sharing=locked')
+        if self.dependency_cache:
+            mounts.append(f'--mount=type=cache,id={self.name}-dependencies,target={self.dependency_cache},sharing=locked')
+
+        # 预下载的文件按组挂载，某组文件的变化不会影响其他层的缓存
+        prefetched_groups = set([ p.group for ps in self.get_packages().values() for p in ps if p.name in self.__prefetched ])
+        for g in groups:
+            if g in prefetched_groups:
+                mounts.append(f'--mount=type=bind,source=prefetch/{g},target={PREFETCH_PATH}/{g}')
+
+        return mounts
+
     def get_home(self, pkg):
         if pkg.version:
             return f'/opt/{pkg.name}/{pkg.version}'
         else:
             return f'/opt/{pkg.name}'
 
+    def use_prefetched(self, prefetched):
+        '''使用预先下载到构建上下文中的文件，参数为软件包名称到文件名的映射
+        '''
+        self.__prefetched = dict(prefetched)
+
     def get_url(self, pkg):
+        if pkg.name in self.__prefetched:
+            return f'file://{PREFETCH_PATH}/{pkg.group}/{self.__prefetched.get(pkg.name)}'
+
         u = pkg.url.format(name = pkg.name, version = pkg.version)
         parsed = parse.urlparse(u)
         if parsed.scheme and self.internal_hub:
@@ -235,40 +572,50 @@ class ShCoder(object):
     def get_local_mirror_address(self, name):
         return self.__internal_hub + '/' + name
 
-    def configure_yum_repos(self, *names):
-        ''' 设置YUM镜像的代码片段
+    def get_mirrors(self, kind):
+        '''获取指定类型的镜像，按测速结果排序；未测速时使用默认的镜像
         '''
-        lines = []
-        
-        lines.append("rm -rf /etc/yum.repos.d/*")
+        if self.__mirrors is not None and kind.name in self.__mirrors:
+            return self.__mirrors.get(kind.name)
+        return get_default_mirrors(load_mirrors()).get(kind.name)
 
-        # lines.extend([
-        #     f'echo "--- Add usts repository"',
-        #     f'curl -k -s -L -o /etc/yum.repos.d/CentOS-Base.repo https://lug.ustc.edu.cn/wiki/_export/code/mirrors/help/centos?codeblock=3'
-        # ])
+    def __yum_repo(self, mirror):
+        repo_file = f'/etc/yum.repos.d/{mirror.name}.repo'
+        lines = [ f'echo "--- Add {mirror.name} repository"' ]
 
-        name = 'aliyun'
-        if not names or name.lower() in names:
-            lines.extend([
-                f'echo "--- Add {name} repository"',
-                f'curl -k -s -L -o /etc/yum.repos.d/{name}.repo https://mirrors.aliyun.com/repo/Centos-{OperateSystemDef.centos.value}.repo',
-                f"sed -i -e '/mirrors.cloud.aliyuncs.com/d' -e '/mirrors.aliyuncs.com/d' /etc/yum.repos.d/{name}.repo"
-            ])
+        url = mirror.url.format(centos = OperateSystemDef.centos.value)
+        if url.endswith('.repo'):
+            lines.append(f'curl -k -s -L -o {repo_file} {url}')
+        else:
+            lines.append(f"sed -e 's|^mirrorlist=|#mirrorlist=|' -e 's|^#\\?baseurl=http://mirror.centos.org/centos|baseurl={url.rstrip('/')}|' /etc/yum.repos.d/CentOS-Base.repo > {repo_file}.tmp && mv -f {repo_file}.tmp {repo_file} || exit $?")
 
-        name = 'netease'
-        if not names or name.lower() in names:
-            lines.extend([
-                f'echo "--- Add {name} repository"',
-                f'curl -k -s -L -o /etc/yum.repos.d/{name}.repo https://mirrors.163.com/.help/CentOS{OperateSystemDef.centos.value}-Base-163.repo'
-            ])
+        if mirror.exclude:
+            excludes = ' '.join([ f"-e '/{e}/d'" for e in mirror.exclude.split() ])
+            lines.append(f'sed -i {excludes} {repo_file}')
 
-        lines.append("yum makecache")
+        return lines
 
-        return '\n'.join(lines)
+    def configure_yum_repos(self, *names):
+        ''' 设置YUM镜像的代码片段
+        '''
+        mirrors = [ m for m in self.get_mirrors(MirrorDefs.yum) if not names or m.name.lower() in names ]
 
-    def install_softwares(self):
         lines = []
 
+        # 先生成新的repo文件再删除原有的，baseurl方式需要以官方repo文件为模板；没有可用镜像时保留官方源
+        for m in mirrors:
+            lines.extend(self.__yum_repo(m))
+        if mirrors:
+            lines.append(f"find /etc/yum.repos.d -name '*.repo' {' '.join([ f'! -name {m.name}.repo' for m in mirrors ])} -delete")
+
+        # 使用保留的YUM缓存时，元数据未过期则不重新下载
+        lines.append("yum makecache fast" if self.yum_cache else "yum makecache")
+
+        return '\n'.join(lines)
+
+    def get_packages(self):
+        '''按组读取已选择的软件包
+        '''
         gpkgs = {}
 
         for section in self.__cp.sections():
@@ -283,74 +630,294 @@ class ShCoder(object):
 
             gpkgs.get(d.get('group')).append(Pkg(name = section, **d))
 
+        return gpkgs
+
+    def get_package(self, name):
+        '''读取指定的软件包，不论所在的组是否已选择；不存在时返回None
+        '''
+        if not self.__cp.has_section(name) or not self.__cp.has_option(name, 'group'):
+            return None
+
+        d = dict(group = None, install = None, version = None, url = None)
+        d.update(dict(list(self.__cp.items(name))))
+        return Pkg(name = name, **d)
+
+    def get_required_packages(self, pkgs, key = 'requires'):
+        '''pkgs依赖的其他软件包（配置项requires，运行时的依赖为runtime_requires），包括间接依赖，被依赖的软件包在前；pkgs中已有的软件包不再列出
+        '''
+        names = set([ p.name for p in pkgs ])
+        required = []
+
+        def require(name):
+            if name in names:
+                return
+            names.add(name)
+            p = self.get_package(name)
+            if not p:
+                warnings.warn(f'Unknown required package: {name}')
+                return
+            for d in (getattr(p, key) or '').split():
+                require(d)
+            required.append(p)
+
+        for p in pkgs:
+            for d in (getattr(p, key) or '').split():
+                require(d)
+        return required
+
+    def install_package(self, p):
+        lines = []
+
+        if InstallDefs.yum.name == p.install:
+            if not self.__yum_batch:
+                lines.append(self.__yum(p))
+        elif InstallDefs.rpm.name == p.install:
+            lines.append(self.__rpm(p))
+
+        f = getattr(self, f'install_{p.name.replace("-", "_")}', None)
+        if f:
+            lines.append(f'#--- Install {p.name}')
+            lines.append(f(p))
+
+        if self.__slim and [ l for l in lines if l ]:
+            _, rpm, dirs = self.__get_size_arguments(p)
+            lines.insert(0, f"langs_size_begin {p.group} {p.name} {rpm} '{dirs}'")
+            lines.append(self.__slim_package(p))
+
+        return self.__step(StepDefs.package, p.name, '\n'.join([l for l in lines if l]))
+
+    def __get_size_arguments(self, p):
+        '''软件包大小统计的参数，返回（安装目录，是否统计RPM，统计的目录）：
+        http安装的软件包统计安装目录和配置项paths中的目录，YUM和RPM安装的软件包统计RPM数据库中的安装大小和配置项paths中的目录
+        '''
+        rpm = InstallDefs.yum.name == p.install or InstallDefs.rpm.name == p.install
+        home_dir = '-' if rpm else self.get_home(p)
+        dirs = ([] if rpm else [ home_dir ]) + [ path for path in (p.paths or '').split() if path != home_dir ]
+        return home_dir, 1 if rpm else 0, ' '.join(dirs)
+
+    def __slim_package(self, p):
+        '''精简软件包并记录大小：以/开头的模式为绝对路径，含/的模式相对于安装目录，其他按文件名在安装目录中查找
+        '''
+        home_dir, rpm, dirs = self.__get_size_arguments(p)
+        paths, names = [], []
+        for pattern in (p.slim or '').split():
+            if pattern.startswith('/'):
+                paths.append(pattern)
+            elif '-' == home_dir:
+                warnings.warn(f'Relative slim pattern of {p.name} is ignored: {pattern}')
+            elif '/' in pattern:
+                paths.append(f'{home_dir}/{pattern}')
+            else:
+                names.append(f"'{pattern}'")
+        return f"langs_slim {p.group} {p.name} {home_dir} {rpm} '{dirs}' '{' '.join(paths)}' {' '.join(names)}".rstrip()
+
+    def __batch_yum(self, g, pkgs):
+        '''合并安装的YUM软件包，精简时作为一个名为yum-{g}的软件包统计大小，并删除各软件包配置项slim中的绝对路径
+        '''
+        content = self.__yum(*pkgs)
+        if not self.__slim or not content:
+            return content
+
+        dirs = ' '.join(dict.fromkeys([ path for p in pkgs for path in (p.paths or '').split() ]))
+        paths = ' '.join([ pattern for p in pkgs for pattern in (p.slim or '').split() if pattern.startswith('/') ])
+        return '\n'.join([
+            f"langs_size_begin {g} yum-{g} 1 '{dirs}'",
+            content,
+            f"langs_slim {g} yum-{g} - 1 '{dirs}' '{paths}'"
+        ])
+
+    def install_group(self, g, pkgs):
+        if self.__parallel:
+            return self.__schedule((g, pkgs))
+
+        lines = []
+
+        lines.append(f'#- Install {g} group')
+        if YumBatchDefs.group.name == self.__yum_batch:
+            lines.append(self.__step(StepDefs.yum, g, self.__batch_yum(g, [ p for p in pkgs if InstallDefs.yum.name == p.install ])))
+
+        for p in pkgs:
+            lines.append(self.install_package(p))
+
+        f = getattr(self, f'after_group_{g.replace("-", "_")}', None)
+        if f: lines.append(self.__step(StepDefs.after_group, g, f()))
+
+        return self.__step(StepDefs.group, g, '\n'.join([l for l in lines if l]))
+
+    def __schedule(self, *gpkgs):
+        '''将各组的软件包生成为后台任务，按配置项requires声明的依赖关系并行安装
+
+        安装yum和rpm的任务持有同一个锁，依赖的软件包不在本次安装中时忽略该依赖。
+        '''
+        jobs = []
+        names = set([ p.name for g, pkgs in gpkgs for p in pkgs ])
+
+        for g, pkgs in gpkgs:
+            batch_job = None
+            yum_pkgs = [ p for p in pkgs if InstallDefs.yum.name == p.install ]
+            if YumBatchDefs.group.name == self.__yum_batch and yum_pkgs:
+                batch_job = f'{g}.yum'
+                jobs.append((batch_job, [], self.__step(StepDefs.yum, g, self.__batch_yum(g, yum_pkgs)), True))
+
+            for p in pkgs:
+                deps = [ d for d in (p.requires or '').split() if d in names ]
+                if batch_job and p in yum_pkgs:
+                    deps.append(batch_job)
+                content = self.install_package(p)
+                jobs.append((p.name, deps, content, bool(content) and p.install in (InstallDefs.yum.name, InstallDefs.rpm.name)))
+
+            f = getattr(self, f'after_group_{g.replace("-", "_")}', None)
+            content = self.__step(StepDefs.after_group, g, f()) if f else ''
+            if content: jobs.append((f'{g}.after', [ p.name for p in pkgs ], content, False))
+
+        # 按依赖关系排序，保证先启动的任务不会等待后启动的任务
+        ordered = []
+        while jobs:
+            started = set([ j[0] for j in ordered ])
+            ready = [ j for j in jobs if all([ d in started for d in j[1] ]) ]
+            if not ready:
+                raise ValueError(f'Circular requires among {", ".join([ j[0] for j in jobs ])}')
+            ordered.append(ready[0])
+            jobs.remove(ready[0])
+
+        lines = []
+        for name, deps, content, locked in ordered:
+            func = f'langs_job_{re.sub(r"[^0-9A-Za-z_]", "_", name)}'
+            lines.append(f'{func}() {{')
+            lines.append(content or ':')
+            lines.append('}')
+            lines.append(f'langs_spawn {name} {func} {1 if locked else 0} {" ".join(deps)}'.rstrip())
+        lines.append('langs_wait_jobs || exit 1')
+
+        return '\n'.join(lines)
+
+    def __step(self, kind, name, content):
+        '''记录步骤的开始和结束时间到编译分析文件中
+
+        步骤在子shell中执行并设置errexit，任一命令失败时步骤以该退出码结束，
+        退出时由trap记录结束时间和退出码，嵌套的步骤失败时外层的步骤也随之失败。
+        '''
+        if not content:
+            return ''
+
+        return '\n'.join([
+            '(',
+            f'langs_step_begin {kind.name} {name}',
+            f"trap 'langs_step_end {kind.name} {name} $?' EXIT",
+            'set -e',
+            content,
+            ')'
+        ])
+
+    def install_batched_yum_packages(self, groups = None):
+        '''将所有组的YUM软件包合并到一个事务中安装，groups为安装的组，默认为全部组
+        '''
+        if YumBatchDefs.all.name != self.__yum_batch:
+            return ''
+
+        groups = self.__groups if groups is None else groups
+        gpkgs = self.get_packages()
+        pkgs = [ p for g in self.__groups if g in groups for p in gpkgs.get(g, []) if InstallDefs.yum.name == p.install ]
+        if not pkgs:
+            return ''
+
+        return self.__step(StepDefs.yum, 'all', '\n'.join([f'#- Install yum packages of all groups', self.__batch_yum('all', pkgs)]))
+
+    def install_softwares(self):
+        lines = []
+
+        gpkgs = self.get_packages()
+
+        lines.append(self.install_batched_yum_packages())
+
+        if self.__parallel:
+            # 所有组的软件包一起调度
+            lines.append(self.__schedule(*[ (g, gpkgs.get(g)) for g in self.__groups if gpkgs.get(g, None) ]))
+            return '\n'.join([l for l in lines if l])
+
         for g in self.__groups:
             pkgs = gpkgs.get(g, None)
             if not pkgs:
                 continue
 
-            lines.append(f'#- Install {g} group')
-            for p in pkgs:
-                if InstallDefs.yum.name == p.install:
-                    lines.append(self.__yum(p))
-                elif InstallDefs.rpm.name == p.install:
-                    lines.append(self.__rpm(p))
-
-                f = getattr(self, f'install_{p.name.replace("-", "_")}', None)
-                if f:
-                    lines.append(f'#--- Install {p.name}')
-                    lines.append(f(p))
-
-            f = getattr(self, f'after_group_{g.replace("-", "_")}', None)
-            if f: lines.append(f())
+            lines.append(self.install_group(g, pkgs))
             lines.append(f'\n\n')
 
         return '\n'.join([l for l in lines if l])
 
-    def __download(self, install, url, output_dir = None):
+    def get_compression(self, filepath):
+        for e in CompressionDefs:
+            if filepath.endswith(e.value):
+                return e
+        return None
+
+    def __fetch(self, pkg, streaming = False):
+        '''下载软件包的代码片段，返回（代码行，文件路径，流式下载命令）；预下载的文件直接使用，不再下载
+        '''
         lines = []
+        url = self.get_url(pkg)
         filepath = f"{self.archive_home}/{os.path.basename(url)}"
 
-        lines.append(f"cd {self.__build_root}")
+        # 有校验和时下载的同时校验
+        sha256 = f' {pkg.sha256.lower()}' if pkg.sha256 else ''
 
-        if InstallDefs.http.name == install:
-            if url.startswith('file://'):
-                lines.append(f'mv -f {url[7:]} {self.archive_home}')
-            elif url.startswith('http'):
-                lines.append(f"curl -skL -o {filepath} {url}")
-        else:
-            Warning.warn(f"Code downloading failed - install({install});url({url})")
+        source_cmd = None
+        if url.startswith('file://'):
+            filepath = url[7:]
+        elif url.startswith('http') and self.download_cache and streaming:
+            source_cmd = f"langs_cached_stream {self.get_cache_key(pkg)} {url}{sha256}"
+        elif url.startswith('http') and self.download_cache:
+            lines.append(f"langs_cached_download {self.get_cache_key(pkg)} {url} {filepath}{sha256} &&")
+        elif url.startswith('http') and streaming:
+            source_cmd = f"langs_stream {url}{sha256}"
+        elif url.startswith('http'):
+            lines.append(f"langs_fetch {url} {filepath}{sha256} &&")
+
+        return lines, filepath, source_cmd
+
+    def __download(self, pkg, output_dir = None):
+        lines = []
+        install = pkg.install
+        url = self.get_url(pkg)
+
+        if InstallDefs.http.name != install:
+            warnings.warn(f"Code downloading failed - install({install});url({url})")
             return
 
+        lines.append(f"cd {self.__build_root}")
+
+        compression = self.get_compression(os.path.basename(url))
+        # zip和rpm需要随机读取，只能先保存为文件
+        streaming = self.__stream and compression not in (None, CompressionDefs.ZIP, CompressionDefs.RPM)
+
+        fetch_lines, filepath, source_cmd = self.__fetch(pkg, streaming)
+        lines.extend(fetch_lines)
+
         if output_dir:
             lines.append(f'rm -rf {output_dir} &&')
             lines.append(f'mkdir -p {os.path.dirname(output_dir)} &&')
         lines.append('temp_dir=`mktemp -d ./tmpd.XXXXXX` &&')
-        if filepath.endswith(CompressionDefs.XZ.value):
-            lines.append(f"xz -d {filepath} &&")
-            lines.append(f"tar -xvf {filepath[:-3]} -C ${{temp_dir}} &&")
-        elif filepath.endswith(CompressionDefs.GZ.value):
-            lines.append(f"tar -zxvf {filepath} -C ${{temp_dir}} &&")
-        elif filepath.endswith(CompressionDefs.BZ).value:
-            lines.append(f"tar -jxvf {filepath} -C ${{temp_dir}} &&")
-        elif filepath.endswith(CompressionDefs.BZ2.value):
-            lines.append(f"tar -jxvf {filepath} -C ${{temp_dir}} &&")
-        elif filepath.endswith(CompressionDefs.Z):
-            lines.append(f"tar -Zxvf {filepath} -C ${{temp_dir}} &&")
-        elif filepath.endswith(CompressionDefs.TAR.value):
-            lines.append(f"tar -xvf {filepath} -C ${{temp_dir}} &&")
-        elif filepath.endswith(CompressionDefs.ZIP.value):
-            lines.append(f"unzip {filepath} -d ${{temp_dir}} &&")
-        # elif filepath.endswith(CompressionDefs.RPM.value):
+        if CompressionDefs.ZIP == compression:
+            lines.append(f"unzip {'' if self.__verbose else '-q '}{filepath} -d ${{temp_dir}} &&")
+        # elif CompressionDefs.RPM == compression:
         #     lines.append(f"cd {output_dir} && {{ rpm2cpio {filepath} | cpio -div }} && cd - >/dev/null")
+        elif compression:
+            # 解压缩和解包通过管道同时进行，不生成中间的tar文件
+            decompress_cmd = f"`langs_decompressor {compression.name}`"
+            if source_cmd:
+                lines.append(f"( set -o pipefail; {source_cmd} | {decompress_cmd} | tar -x{'v' if self.__verbose else ''}f - -C ${{temp_dir}} ) &&")
+            else:
+                lines.append(f"( set -o pipefail; {decompress_cmd} < {filepath} | tar -x{'v' if self.__verbose else ''}f - -C ${{temp_dir}} ) &&")
         if output_dir:
-            lines.append(f"find $temp_dir -maxdepth 1 -mindepth 1 -type d -execdir mv -vf {{}} {output_dir} \; &&")
+            lines.append(f"find $temp_dir -maxdepth 1 -mindepth 1 -type d -execdir mv -{'v' if self.__verbose else ''}f {{}} {output_dir} \; &&")
             lines.append("rm -rf $temp_dir &&")
             lines.append("unset temp_dir &&")
-            lines.append(f"output_dir={output_dir}")
+            lines.append(f"output_dir={output_dir} &&")
         else:
-            lines.append(f"output_dir=\"$(find $temp_dir -maxdepth 1 -mindepth 1 -type d)\"")
+            lines.append(f"output_dir=\"$(find $temp_dir -maxdepth 1 -mindepth 1 -type d)\" &&")
 
-        lines.append(f"cd - >/dev/null")
+        # errexit不检查&&连接的命令列表中间的失败，下载或解压失败时显式结束步骤，返回失败命令的退出码
+        lines.append(f"cd - >/dev/null || exit $?")
 
         return "\n".join(lines)
 
@@ -363,15 +930,17 @@ class ShCoder(object):
         rpms = []
         for p in pkgs:
             if p.url:
-                rpms.append(self.get_url(p))
+                names = self.get_url(p).split()
             elif p.version:
-                rpms.append(f"{p.name}-{p.version}")
+                names = [f"{p.name}-{p.version}"]
             else:
-                rpms.append(p.name)
+                names = [p.name]
+            # 去除重复的软件包，如{name}-devel展开后的重复项
+            rpms.extend([ n for n in names if n not in rpms ])
 
         rpm_str = " ".join(rpms)
         lines.append(f'#--- Install {rpm_str}')
-        lines.append(f'yum install -y {rpm_str}')
+        lines.append(f'yum install -y {"--setopt=tsflags=nodocs " if self.__slim else ""}{rpm_str}')
 
         return '\n'.join(lines)
 
@@ -383,165 +952,337 @@ class ShCoder(object):
 
         for p in pkgs:
             lines.append(f'#--- Install {p.name}')
-            lines.append(f'rpm -ivh {self.get_url(p)}')
+            # 先下载再安装，以便重试和校验
+            fetch_lines, filepath, _ = self.__fetch(p)
+            lines.extend(fetch_lines)
+            lines.append(f'rpm -ivh {filepath}{" || exit $?" if fetch_lines else ""}')
+
+        return '\n'.join(lines)
+
+    def __compile(self, pkg, configure_opts):
+        '''源码编译安装，并行编译，可选使用ccache；配置项configure追加编译选项，如--enable-optimizations --with-lto
+        '''
+        lines = []
+
+        if self.ccache:
+            lines.append('langs_enable_ccache')
+        lines.append(f'./configure {configure_opts} {pkg.configure or ""}'.rstrip() + ' &&')
+        lines.append('make -j${LANGS_JOBS} &&')
+        lines.append('make install')
+
+        return '\n'.join(lines)
+
+    def get_artifact_key(self, pkg, configure_opts):
+        '''编译产物的键，由软件包配置和编译选项计算得到
+        '''
+        d = dict(self.__cp.items(pkg.name))
+        d.update(dict(os = self.get_centos_image_info(), configure_opts = configure_opts))
+        digest = hashlib.sha256(json.dumps(d, sort_keys = True).encode('utf-8')).hexdigest()
+        return f'{pkg.name}-{pkg.version}-{digest[:16]}'
+
+    def __build_from_source(self, pkg, configure_opts):
+        '''下载源码并编译安装；启用编译产物缓存时，命中则直接解压安装目录
+        '''
+        lines = []
+
+        key = self.get_artifact_key(pkg, configure_opts)
+        home_dir = self.get_home(pkg)
+
+        if self.artifact_cache:
+            lines.append(f'if ! langs_restore_artifact {key} {home_dir}; then')
+        lines.append(self.__download(pkg))
+        lines.append('cd $output_dir')
+        if self.artifact_cache:
+            # 只保存编译安装成功的产物
+            lines.append(self.__compile(pkg, configure_opts) + ' &&')
+            lines.append(f'langs_save_artifact {key} {home_dir} || exit $?')
+        else:
+            lines.append(self.__compile(pkg, configure_opts) + ' || exit $?')
+        lines.append(f'cd {self.__build_root}')
+        lines.append('rm -rf $output_dir')
+        if self.artifact_cache:
+            lines.append('fi')
 
         return '\n'.join(lines)
 
     def install_cmake(self, pkg):
         home_dir = self.get_home(pkg)
 
-        content_str = f'''
-        {self.__download(install = pkg.install, url = self.get_url(pkg), output_dir = home_dir)}
-        cat >> ${{BASH_PROFILE}} <<EOF
+        return self.__download(pkg, output_dir = home_dir)
 
-        # cmake
-        export LD_LIBRARY_PATH={home_dir}/lib:\\${{LD_LIBRARY_PATH}}
-        export PATH=\\${{PATH}}:{home_dir}/bin
-        EOF
+    def environment_cmake(self, pkg):
+        home_dir = self.get_home(pkg)
+        return [ ('PATH', f'{home_dir}/bin'), ('LD_LIBRARY_PATH', f'{home_dir}/lib') ]
+
+    def __preload(self, kind, store_dir, command):
+        '''预装依赖的代码片段：启用依赖缓存时先从缓存恢复到store_dir，预装成功后再保存到缓存
         '''
+        if not self.dependency_cache:
+            return command
 
-        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
+        return '\n'.join([
+            f'langs_restore_dependencies {kind} {store_dir}',
+            f'{command} &&',
+            f'langs_save_dependencies {kind} {store_dir}'
+        ])
 
-        return content_str
+    def __preload_python(self, pkg):
+        '''预装配置项preload中的Python包，启用依赖缓存时缓存目录作为wheelhouse，命中时不访问网络
+        '''
+        if not pkg.preload:
+            return ''
 
-    def install_python(self, pkg):
-        home_dir = self.get_home(pkg)
+        pip = f'{self.get_home(pkg)}/bin/python3 -m pip'
+        if not self.dependency_cache:
+            return f'{pip} install {pkg.preload}'
 
-        content_str = f'''
-        mkdir -p {home_dir}
-        {self.__download(install = pkg.install, url = self.get_url(pkg))}
-        cd $output_dir
-        ./configure --prefix={home_dir} --enable-shared --with-libs='/usr/lib64/libcrypto.so /usr/lib64/libssl.so' --with-ssl
-        make
-        make install
-        cd {self.__build_root}
-        rm -rf $output_dir
+        wheelhouse = f'{self.dependency_cache}/wheels'
+        return f'{pip} install --no-index --find-links {wheelhouse} {pkg.preload} || {{ {pip} wheel --wheel-dir {wheelhouse} --find-links {wheelhouse} {pkg.preload} && {pip} install --no-index --find-links {wheelhouse} {pkg.preload}; }}'
 
-        cat > /etc/pip.conf <<EOF
-        [global]
-        timeout = 120
-        index-url = https://mirrors.aliyun.com/pypi/simple/
+    def __pip_conf(self):
+        '''总是生成/etc/pip.conf（配置项paths中的路径，多阶段构建时需要复制），有pypi镜像时使用镜像
+        '''
+        mirrors = self.get_mirrors(MirrorDefs.pypi)
+        mirror_str = '' if not mirrors else f'''
+        index-url = {mirrors[0].url}
 
         [install]
-        trusted-host = mirrors.aliyun.com
-        disable-pip-version-check = false
+        trusted-host = {parse.urlparse(mirrors[0].url).hostname}
+        disable-pip-version-check = false'''
+
+        content_str = f'''
+        cat > /etc/pip.conf <<EOF
+        [global]
+        timeout = 120{mirror_str}
         EOF
+        '''
 
-        cat >> ${{BASH_PROFILE}} <<EOF
+        return '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
 
-        # Python
-        export LD_LIBRARY_PATH={home_dir}/lib:\\${{LD_LIBRARY_PATH}}
-        export PATH=\\${{PATH}}:{home_dir}/bin
-        EOF
+    def install_python(self, pkg):
+        home_dir = self.get_home(pkg)
 
-        sh -i -l <<EOF
-        source ${{BASH_PROFILE}}
-        python3 -m pip install wheel pipenv
-        EOF
+        content_str = f'''
+        mkdir -p {home_dir}
+        {self.__build_from_source(pkg, f"--prefix={home_dir} --enable-shared --with-libs='/usr/lib64/libcrypto.so /usr/lib64/libssl.so' --with-ssl")}
+
+        {self.__pip_conf()}
+
+        {self.__preload_python(pkg)}
         '''
 
-        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
+        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l.strip()])
 
         return content_str
 
+    def environment_python(self, pkg):
+        home_dir = self.get_home(pkg)
+        return [ ('PATH', f'{home_dir}/bin'), ('LD_LIBRARY_PATH', f'{home_dir}/lib') ]
+
     def install_node(self, pkg):
         home_dir = self.get_home(pkg)
 
+        preload_str = ''
+        if pkg.preload:
+            preload_str = self.__preload('npm', '${HOME}/.npm', ' && '.join([ f'{home_dir}/bin/npm cache add {d}' for d in pkg.preload.split() ]))
+
         content_str = f'''
         mkdir -p {home_dir}
-        {self.__download(install = pkg.install, url = self.get_url(pkg), output_dir = home_dir)}
-        cat >> ${{BASH_PROFILE}} <<EOF
-
-        # Node
-        export LD_LIBRARY_PATH={home_dir}/lib:\\${{LD_LIBRARY_PATH}}
-        export PATH=\\${{PATH}}:{home_dir}/bin
-        EOF
+        {self.__download(pkg, output_dir = home_dir)}
+        {self.__npmrc(pkg)}
+        mkdir -p ${{HOME}}/.npm
+        {preload_str}
         '''
 
-        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
+        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l.strip()])
 
         return content_str
 
-    def install_openjdk(self, pkg):
-        content_str = f'''
-        cat >> ${{BASH_PROFILE}} <<EOF
+    def __npmrc(self, pkg):
+        '''npm的全局配置文件，位于安装目录中，与pip.conf使用同一套镜像设置
+        '''
+        mirrors = self.get_mirrors(MirrorDefs.npm)
+        if not mirrors:
+            return ''
+
+        home_dir = self.get_home(pkg)
+        return f'mkdir -p {home_dir}/etc && echo "registry={mirrors[0].url}" > {home_dir}/etc/npmrc'
+
+    def environment_node(self, pkg):
+        home_dir = self.get_home(pkg)
+        return [ ('PATH', f'{home_dir}/bin'), ('LD_LIBRARY_PATH', f'{home_dir}/lib') ]
 
-        # Java
-        export JAVA_HOME=/usr/lib/jvm/java-{pkg.version}-openjdk/
-        export CLASSPATH=.:\\${{JAVA_HOME}}/lib:\\${{JAVA_HOME}}/lib/dt.jar:\\${{JAVA_HOME}}/lib/tools.jar
-        export PATH=\\${{PATH}}:\\${{JAVA_HOME}}/bin
+    def install_maven(self, pkg):
+        '''Maven的settings.xml，与pip.conf使用同一套镜像设置；预装配置项preload中的构件到本地仓库
+        '''
+        mirrors = self.get_mirrors(MirrorDefs.maven)
+
+        mirror_str = '\n'.join([ f'''
+                <mirror>
+                    <id>{m.name}</id>
+                    <mirrorOf>central</mirrorOf>
+                    <name>{m.name}</name>
+                    <url>{m.url}</url>
+                </mirror>''' for m in mirrors[:1] ])
+
+        preload_str = ''
+        if pkg.preload:
+            preload_str = self.__preload('maven', '${HOME}/.m2/repository', ' && '.join([ f'mvn -B -q dependency:get -Dartifact={d}' for d in pkg.preload.split() ]))
+
+        content_str = f'''
+        mkdir -p ${{HOME}}/.m2
+        cat > ${{HOME}}/.m2/settings.xml <<EOF
+        <settings>
+            <mirrors>{mirror_str}
+            </mirrors>
+        </settings>
         EOF
-        # MAVEN的SETTINGS设置
+        {preload_str}
         '''
 
-        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
+        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l.strip()])
 
         return content_str
 
-    def install_rust(self, pkg):
-        RUSTUP_REGISTRY = "mirrors.sjtug.sjtu.edu.cn"
-        RUSTUP_REGISTRY_NAME = "utsc"
+    def environment_openjdk(self, pkg):
+        java_home = f'/usr/lib/jvm/java-{pkg.version}-openjdk'
+        return [
+            ('JAVA_HOME', f'{java_home}/'),
+            ('CLASSPATH', f'.:{java_home}/lib:{java_home}/lib/dt.jar:{java_home}/lib/tools.jar'),
+            ('PATH', f'{java_home}/bin')
+        ]
 
+    def install_rustup_init(self, pkg):
+        home_dir = self.get_home(pkg)
+        fetch_lines, filepath, _ = self.__fetch(pkg)
+
+        # 不安装工具链，工具链由离线安装包安装后链接；安装后rustup-init指向rustup，两者是同一个程序
         content_str = f'''
-        ENV_FILE="$HOME/.rust-env"
+        cd {self.__build_root}
+        {" ".join(fetch_lines)}
+        mkdir -p {home_dir} &&
+        install -m 755 {filepath} {home_dir}/rustup-init &&
+        {home_dir}/rustup-init -y --no-modify-path --default-toolchain none &&
+        ln -sf ${{HOME}}/.cargo/bin/rustup {home_dir}/rustup-init
+        '''
 
-        cat >> $ENV_FILE <<EOF
-        # 安装Rust环境
-        export RUSTUP_DIST_SERVER=https://{RUSTUP_REGISTRY}/rust-static
-        export RUSTUP_UPDATE_ROOT=\\${{RUSTUP_DIST_SERVER}}/rustup
-        EOF
+        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l.strip()])
 
-        source $ENV_FILE
-        curl https://sh.rustup.rs -sSf | sh -s -- -y
+        return content_str
 
-        cat $ENV_FILE >> ${{BASH_PROFILE}}
+    def get_crates_registry(self, pkg):
+        '''crates.io的替换源，返回（名称，配置项，地址）：优先使用配置项registry，其次是rustup镜像
 
-        cat >> $HOME/.cargo/config <<EOF
+        registry为绝对路径时是本地目录，为URL时直接使用，其他为内部仓库中的路径，如crates.io-index；
+        内部仓库不一定提供git索引，只有配置项registry指定时才使用。
+        '''
+        if pkg.registry and pkg.registry.startswith('/'):
+            # 本地目录，如cargo local-registry生成的索引和crate文件，编译时不访问网络
+            return 'local', 'local-registry', pkg.registry
+        if pkg.registry and parse.urlparse(pkg.registry).scheme:
+            return 'local', 'registry', pkg.registry
+        if pkg.registry and self.internal_hub:
+            return 'internal', 'registry', self.get_internal_mirror(pkg.registry)
+        if pkg.registry:
+            warnings.warn(f'Registry {pkg.registry} of {pkg.name} requires --internal-hub, ignored')
+
+        mirrors = self.get_mirrors(MirrorDefs.rustup)
+        if mirrors and mirrors[0].registry:
+            return mirrors[0].name, 'registry', mirrors[0].registry
+        return None
+
+    def install_rust(self, pkg):
+        home_dir = self.get_home(pkg)
+        toolchain = f'langs-{pkg.version}'
+
+        # 使用固定版本的离线安装包，与其他软件包一样经过下载缓存和预下载，不再通过rustup从网络下载工具链
+        # cargo的锁文件链接到registry目录中，共用registry的容器使用同一个锁
+        content_str = f'''
+        {self.__download(pkg)}
+        cd $output_dir
+        ./install.sh --prefix={home_dir} --without=rust-docs --disable-ldconfig
+        cd {self.__build_root}
+        rm -rf $output_dir
+        ${{HOME}}/.cargo/bin/rustup toolchain link {toolchain} {home_dir}
+        ${{HOME}}/.cargo/bin/rustup default {toolchain}
+        mkdir -p ${{HOME}}/.cargo/registry && ln -sf ${{HOME}}/.cargo/registry/.package-cache ${{HOME}}/.cargo/.package-cache
+        '''
+
+        registry = self.get_crates_registry(pkg)
+        if registry:
+            name, key, url = registry
+            content_str += f'''
+        cat > $HOME/.cargo/config <<EOF
         [source.crates-io]
         registry = "https://github.com/rust-lang/crates.io-index"
-        replace-with = '{RUSTUP_REGISTRY_NAME}'
+        replace-with = '{name}'
 
-        [source.{RUSTUP_REGISTRY_NAME}]
-        registry = 'git://{RUSTUP_REGISTRY}/crates.io-index
+        [source.{name}]
+        {key} = '{url}'
         EOF
-
-        rm -f ${{ENV_FILE}}
-        unset ENV_FILE
         '''
 
-        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
+        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l.strip()])
 
         return content_str
 
+    def environment_rust(self, pkg):
+        mirrors = self.get_mirrors(MirrorDefs.rustup)
+        env = [ ('PATH', '${HOME}/.cargo/bin') ]
+        if mirrors:
+            env.extend([ ('RUSTUP_DIST_SERVER', mirrors[0].url), ('RUSTUP_UPDATE_ROOT', f'{mirrors[0].url}/rustup') ])
+        return env
+
+
     def install_golang(self, pkg):
         home_dir = self.get_home(pkg)
 
         content_str = f'''
         mkdir -p {home_dir}
-        {self.__download(install = pkg.install, url = self.get_url(pkg), output_dir = home_dir)}
+        {self.__download(pkg, output_dir = home_dir)}
+        mkdir -p ${{GOPATH}}
+        {self.__preload_golang(pkg)}
+        '''
 
-        GO_WORKSPACE=${{HOME}}/gowork
-        mkdir -p ${{GO_WORKSPACE}}
-        cat >> ${{BASH_PROFILE}} <<EOF
+        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l.strip()])
 
-        # Go
-        export GOPATH=${{GO_WORKSPACE}}
-        export PATH=\\${{PATH}}:{home_dir}/bin
-        EOF
-        unset GO_WORKSPACE
+        return content_str
+
+    def __preload_golang(self, pkg):
+        '''在临时模块中下载配置项preload中的模块到GOPATH的模块缓存，格式为模块@版本
         '''
+        if not pkg.preload:
+            return ''
 
-        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
+        go = f'{self.get_home(pkg)}/bin/go'
+        return self.__preload('go', '${GOPATH}/pkg/mod', f'( tmp=`mktemp -d` && trap "rm -rf ${{tmp}}" EXIT && cd ${{tmp}} && {go} mod init langs/preload && {go} get -d {pkg.preload} )')
+
+    def environment_golang(self, pkg):
+        # 模块缓存可能由多个容器共用，目录保持可写以便在宿主机上清理；并发访问由go命令的文件锁保证
+        env = [ ('GOPATH', '${HOME}/gowork'), ('PATH', f'{self.get_home(pkg)}/bin'), ('GOFLAGS', '-modcacherw') ]
+        # GOPROXY支持逗号分隔的多个地址，依次回退，最后直连
+        mirrors = self.get_mirrors(MirrorDefs.go)
+        if mirrors:
+            env.append(('GOPROXY', ",".join([ m.url for m in mirrors ] + ["direct"])))
+        return env
+
+    def __ssh_host_keys(self):
+        if EntrypointDefs.supervisor == self.__entrypoint:
+            # 主机密钥由入口脚本在容器首次启动时生成，不同的容器不共用密钥
+            return ''
 
-        return content_str
+        content_str = f'''
+        ssh-keygen -q -t rsa -b 2048 -f /etc/ssh/ssh_host_rsa_key -N ''
+        ssh-keygen -q -t ecdsa -f /etc/ssh/ssh_host_ecdsa_key -N ''
+        ssh-keygen -t dsa -f /etc/ssh/ssh_host_ed25519_key  -N ''
+        '''
+        return '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
 
     def after_group_ssh(self):
         content_str = f'''
         mkdir -p /var/run/sshd
         echo "root:abc123" | chpasswd
-        ssh-keygen -q -t rsa -b 2048 -f /etc/ssh/ssh_host_rsa_key -N ''
-        ssh-keygen -q -t ecdsa -f /etc/ssh/ssh_host_ecdsa_key -N ''
-        ssh-keygen -t dsa -f /etc/ssh/ssh_host_ed25519_key  -N ''
+        {self.__ssh_host_keys()}
         # sed 's@session\s*required\s*pam_loginuid.so@session optional pam_loginuid.so@g' -i /etc/pam.d/sshd
         sed -i /etc/ssh/sshd_config \\
             -e 's/#UsePrivilegeSeparation.*/UsePrivilegeSeparation no/g' \\
@@ -577,42 +1318,488 @@ class ShCoder(object):
     def after_group_golang(self):
         return ''
 
-    def get_software_script_content(self):
+    def parse_locale(self, locale):
+        '''解析区域设置的名称，如zh_CN.UTF-8、sr_RS.UTF-8@latin，返回（localedef的输入，字符集）；未指定字符集时为UTF-8
+        '''
+        m = re.match(r'^([A-Za-z]+(?:_[A-Za-z]+)?)(?:\.([^@]+))?(?:@(.+))?$', locale)
+        if not m:
+            raise ValueError(f'Invalid locale: {locale}')
+        return f'{m.group(1)}@{m.group(3)}' if m.group(3) else m.group(1), m.group(2) or 'UTF-8'
+
+    def get_locale_name(self, locale):
+        '''glibc规范化后的区域设置名称，如zh_CN.UTF-8为zh_CN.utf8，与CentOS的locale-archive和%_install_langs中的名称一致
+        '''
+        source, charmap = self.parse_locale(locale)
+        name, _, modifier = source.partition('@')
+        codeset = re.sub(r'[^0-9a-z]', '', charmap.lower())
+        # 只有数字的字符集加上iso前缀，如8859-1为iso88591
+        codeset = f'iso{codeset}' if codeset.isdigit() else codeset
+        return f'{name}.{codeset}' + (f'@{modifier}' if modifier else '')
+
+    def environment_locale(self):
+        '''第一个区域设置作为默认的语言环境
+        '''
+        # 未指定字符集时生成的是UTF-8，使用规范化的名称
+        locale = self.__locales[0] if '.' in self.__locales[0] else self.get_locale_name(self.__locales[0])
+        name = self.parse_locale(locale)[0].partition('@')[0]
+        language = f'{name}:{name.partition("_")[0]}' if '_' in name else name
+        return [ ('LANG', locale), ('LANGUAGE', language), ('LC_ALL', locale) ]
+
+    def get_locale_content(self):
+        '''只生成指定的区域设置，写入新的locale-archive；镜像中缺少区域设置的源文件时才重新安装glibc-common
+        '''
+        locales = [ (self.get_locale_name(locale), *self.parse_locale(locale)) for locale in self.__locales ]
+        sources = ' '.join(dict.fromkeys([ f'/usr/share/i18n/locales/{i}' for _, i, _ in locales ] + [ f'/usr/share/i18n/charmaps/{c}.gz' for _, _, c in locales ]))
+        # localedef有警告时退出码为1，但区域设置已经生成
+        localedef_str = ' &&\n'.join([ f'{{ localedef -c -i {i} -f {c} {locale} || [ $? -eq 1 ]; }}' for locale, i, c in locales ])
+
+        content_str = f'''
+        #设置语言环境
+        # glibc-common更新时也只生成这些区域设置，作为rpm的%_install_langs，以冒号分隔
+        {{ sed -i -e '/^override_install_langs=/d' /etc/yum.conf && echo "override_install_langs={":".join([ locale for locale, _, _ in locales ])}" >> /etc/yum.conf; }} &&
+        {{ ls {sources} >/dev/null 2>&1 || yum -y reinstall glibc-common; }} &&
+        rm -f /usr/lib/locale/locale-archive /usr/lib/locale/locale-archive.tmpl &&
+        {localedef_str} &&
+        echo 'LANG={dict(self.environment_locale()).get("LANG")}' > /etc/locale.conf
+        '''
+
+        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l.strip()])
+        return self.__step(StepDefs.phase, 'locale', content_str)
+
+    def get_locale_env(self):
+        return ' '.join([ f'{name}="{value}"' for name, value in self.environment_locale() ])
+
+    def get_environment(self, groups = None):
+        '''合并指定组中所有软件包的环境变量，返回（变量，PATH目录，动态库目录），目录已去重
+        '''
+        groups = self.__groups if groups is None else groups
+        variables, paths, libs = {}, [], []
+
+        gpkgs = self.get_packages()
+        env = self.environment_locale()
+        for g in [ g for g in self.__groups if g in groups ]:
+            for p in gpkgs.get(g, []):
+                f = getattr(self, f'environment_{p.name.replace("-", "_")}', None)
+                if f: env.extend(f(p))
+
+        for name, value in env:
+            if 'PATH' == name:
+                paths.extend([ value ] if value not in paths else [])
+            elif 'LD_LIBRARY_PATH' == name:
+                libs.extend([ value ] if value not in libs else [])
+            else:
+                variables.update({ name : value })
+
+        return variables, paths, libs
+
+    def get_environment_lines(self, groups = None, ldconfig = False):
+        '''预先计算的环境变量，PATH追加、LD_LIBRARY_PATH前置；已包含第一个目录时不再重复添加'''
+        variables, paths, libs = self.get_environment(groups)
+
+        lines = [ f'export {name}="{value}"' for name, value in variables.items() ]
+        if paths:
+            lines.append(f'case ":${{PATH}}:" in *":{paths[0]}:"*) ;; *) export PATH="${{PATH}}:{":".join(paths)}" ;; esac')
+        if libs and not ldconfig:
+            lines.append(f'case ":${{LD_LIBRARY_PATH}}:" in *":{libs[0]}:"*) ;; *) export LD_LIBRARY_PATH="{":".join(libs)}${{LD_LIBRARY_PATH:+:${{LD_LIBRARY_PATH}}}}" ;; esac')
+        return lines
+
+    def get_environment_content(self, groups = None):
+        '''将合并后的环境变量写到/etc/profile.d/langs.sh，登录和执行ssh命令时只读取一个文件；
+        使用ldconfig时动态库目录写到/etc/ld.so.conf.d/langs.conf，不再设置LD_LIBRARY_PATH
+        '''
+        lines = [
+            f"cat > {ENVIRONMENT_PATH} <<'EOF'",
+            f'# Generated by {self.name}',
+            *self.get_environment_lines(groups, self.__ldconfig),
+            'EOF'
+        ]
+
+        _, _, libs = self.get_environment(groups)
+        if self.__ldconfig and libs:
+            lines.extend([
+                f"cat > {LD_SO_CONF_PATH} <<'EOF'",
+                *libs,
+                'EOF',
+                'ldconfig'
+            ])
+
+        return self.__step(StepDefs.phase, 'environment', '\n'.join(lines))
+
+    def get_script_functions(self):
+        '''编译脚本中使用的公共函数
+        '''
+        lines = []
+
+        # 并行编译的任务数，默认与CPU数量一致
+        lines.append(f'LANGS_JOBS={self.__jobs or "`nproc`"}')
+
+        content_str = f'''
+        # 编译分析：记录每个步骤的单调时间（/proc/uptime），每行一个JSON对象
+        LANGS_PROFILE={PROFILE_PATH}
+        mkdir -p `dirname ${{LANGS_PROFILE}}`
+
+        langs_now() {{
+            cut -d ' ' -f 1 /proc/uptime
+        }}
+
+        # 参数：类型 名称
+        langs_step_begin() {{
+            langs_now > "${{LANGS_PROFILE}}.$1.$2"
+        }}
+
+        # 参数：类型 名称 退出码
+        langs_step_end() {{
+            local start=`cat "${{LANGS_PROFILE}}.$1.$2" 2>/dev/null`
+            rm -f "${{LANGS_PROFILE}}.$1.$2"
+            echo "{{\\"kind\\": \\"$1\\", \\"name\\": \\"$2\\", \\"start\\": ${{start:-0}}, \\"end\\": `langs_now`, \\"status\\": ${{3:-0}}}}" >> ${{LANGS_PROFILE}}
+        }}
+        '''
+        lines.append('\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l]))
+
+        content_str = f'''
+        # 根据压缩格式选择解压命令，优先使用多线程的解压工具；CentOS的基础仓库中没有zstd时从EPEL安装。参数：CompressionDefs的名称
+        langs_decompressor() {{
+            case "$1" in
+                {CompressionDefs.XZ.name}) command -v pixz >/dev/null 2>&1 && echo "pixz -d" || echo "xz -dc -T0" ;;
+                {CompressionDefs.GZ.name}) command -v pigz >/dev/null 2>&1 && echo "pigz -dc" || echo "gzip -dc" ;;
+                {CompressionDefs.BZ.name}|{CompressionDefs.BZ2.name}) command -v pbzip2 >/dev/null 2>&1 && echo "pbzip2 -dc" || echo "bzip2 -dc" ;;
+                {CompressionDefs.Z.name}) echo "gzip -dc" ;;
+                {CompressionDefs.ZST.name})
+                    command -v zstd >/dev/null 2>&1 || {{ yum install -y zstd || {{ yum install -y epel-release && yum install -y zstd; }}; }} >&2
+                    echo "zstd -dc -T0" ;;
+                {CompressionDefs.TAR.name}) echo "cat" ;;
+                *) echo "cat" ;;
+            esac
+        }}
+        '''
+        lines.append('\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l]))
+
+        if self.__slim:
+            content_str = f'''
+            # 软件包大小统计，每行一个JSON对象：只统计软件包自身的文件，不受下载缓存、缓存挂载和同一主机上并发构建的影响；
+            # http安装的软件包统计目录的大小，YUM和RPM安装的软件包统计RPM数据库中安装大小的变化，安装它们的并行任务持有同一个锁
+            LANGS_SIZE_REPORT={SIZE_REPORT_PATH}
+            mkdir -p `dirname ${{LANGS_SIZE_REPORT}}`
+
+            # RPM数据库中所有软件包的安装大小（字节）
+            langs_rpm_size() {{
+                rpm -qa --qf '%{{SIZE}}\\n' | awk '{{ s += $1 }} END {{ printf "%d\\n", s }}'
+            }}
+
+            # 路径的总大小（字节），路径可以含有通配符，不存在的路径忽略，重叠的路径只统计一次。参数：路径...
+            langs_du() {{
+                local path paths=
+                for path in $*; do
+                    if [ -e "${{path}}" ]; then paths="${{paths}} ${{path}}"; fi
+                done
+                if [ -z "${{paths}}" ]; then echo 0; return 0; fi
+                du -sxbc ${{paths}} 2>/dev/null | tail -n 1 | cut -f 1
+            }}
+
+            # 参数：组 名称 是否统计RPM（0或1） 统计的目录（空格分隔）
+            langs_size_begin() {{
+                echo "`[ 1 -eq $3 ] && langs_rpm_size || echo 0` `langs_du $4`" > "${{LANGS_SIZE_REPORT}}.$1.$2"
+            }}
+
+            # 删除匹配的文件并去除安装目录中二进制文件的符号表，记录软件包增加和回收的空间，保留安装步骤的退出码。
+            # 参数：组 名称 安装目录（无则为-） 是否统计RPM 统计的目录 删除的路径（空格分隔，可以含有通配符） 在安装目录中删除的文件名...
+            langs_slim() {{
+                local status=$? group=$1 name=$2 home=$3 rpm=$4 dirs=$5 paths=$6 rpm_start dirs_start added before pattern
+                shift 6
+                if [ -f "${{LANGS_SIZE_REPORT}}.${{group}}.${{name}}" ]; then
+                    read rpm_start dirs_start < "${{LANGS_SIZE_REPORT}}.${{group}}.${{name}}"
+                    rm -f "${{LANGS_SIZE_REPORT}}.${{group}}.${{name}}"
+                fi
+                added=$((`langs_du ${{dirs}}` - ${{dirs_start:-0}}))
+                if [ 1 -eq ${{rpm}} ]; then
+                    added=$((added + `langs_rpm_size` - ${{rpm_start:-0}}))
+                fi
+                before=`langs_du ${{dirs}} ${{paths}}`
+                for pattern in ${{paths}}; do rm -rf ${{pattern}}; done
+                if [ -d "${{home}}" ]; then
+                    for pattern in "$@"; do
+                        find "${{home}}" -depth -name "${{pattern}}" -exec rm -rf {{}} +
+                    done
+                    if command -v strip >/dev/null 2>&1; then
+                        find "${{home}}" -type f \\( -perm -u+x -o -name '*.so' -o -name '*.so.*' \\) -print0 | xargs -0 -r strip --strip-unneeded 2>/dev/null || true
+                    fi
+                fi
+                echo "{{\\"group\\": \\"${{group}}\\", \\"name\\": \\"${{name}}\\", \\"added\\": ${{added}}, \\"reclaimed\\": $((before - `langs_du ${{dirs}}`))}}" >> ${{LANGS_SIZE_REPORT}}
+                return ${{status}}
+            }}
+            '''
+            lines.append('\n'.join([ l[12:] if l.startswith(' '*12) else l for l in content_str.split('\n') if l]))
+
+        content_str = f'''
+        # 下载的重试次数，重试间隔从2秒开始按指数退避；长时间没有数据时中断连接后重试
+        LANGS_FETCH_RETRIES={self.__fetch_retries}
+        LANGS_CURL="curl -fskL --connect-timeout 30 --speed-limit 1024 --speed-time 60"
+
+        # 下载文件，失败时退避重试并从已下载的部分断点续传，指定校验和时校验不通过则重新下载。参数：URL 输出文件 [SHA256]
+        langs_fetch() {{
+            local part="$2.part" delay=2 i status
+            for i in `seq 1 ${{LANGS_FETCH_RETRIES}}`; do
+                ${{LANGS_CURL}} -C - -o "${{part}}" "$1"
+                status=$?
+                if [ 0 -eq ${{status}} ]; then
+                    if [ -z "$3" ] || echo "$3  ${{part}}" | sha256sum -c --status -; then
+                        mv -f "${{part}}" "$2"
+                        return 0
+                    fi
+                    echo "--- Checksum mismatch: $1"
+                    rm -f "${{part}}"
+                elif [ 33 -eq ${{status}} ]; then
+                    # 服务器不支持断点续传，下次重新下载
+                    rm -f "${{part}}"
+                fi
+                [ ${{i}} -lt ${{LANGS_FETCH_RETRIES}} ] || break
+                echo "--- Retry download in ${{delay}}s (${{i}}/${{LANGS_FETCH_RETRIES}}): $1"
+                sleep ${{delay}}
+                delay=$((delay * 2))
+            done
+            return 1
+        }}
+
+        # 下载文件并输出到标准输出，同时计算校验和，校验不通过时返回失败。参数：URL [SHA256]
+        langs_stream() {{
+            [ -n "$2" ] || {{ ${{LANGS_CURL}} --retry ${{LANGS_FETCH_RETRIES}} "$1"; return; }}
+            local sum=`mktemp`
+            {{ ( set -o pipefail; ${{LANGS_CURL}} --retry ${{LANGS_FETCH_RETRIES}} "$1" | tee /dev/fd/3 | sha256sum | cut -d ' ' -f 1 > ${{sum}} ); }} 3>&1 || {{ rm -f ${{sum}}; return 1; }}
+            if [ "`cat ${{sum}}`" != "$2" ]; then
+                echo "--- Checksum mismatch: $1" >&2
+                rm -f ${{sum}}
+                return 1
+            fi
+            rm -f ${{sum}}
+        }}
+        '''
+        lines.append('\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l]))
+
+        if self.__parallel:
+            content_str = f'''
+            # 并行安装的任务调度，任务的状态文件为：pending、done、failed
+            LANGS_JOBS_DIR={self.__build_root}/.jobs
+            LANGS_MAX_PARALLEL={self.__parallel}
+
+            # 获取一个空闲的任务槽，输出槽的编号
+            langs_acquire_slot() {{
+                while true; do
+                    for i in `seq 1 ${{LANGS_MAX_PARALLEL}}`; do
+                        mkdir ${{LANGS_JOBS_DIR}}/slot.${{i}} 2>/dev/null && echo ${{i}} && return 0
+                    done
+                    sleep 0.2
+                done
+            }}
+
+            # 在后台启动任务，等待依赖的任务完成后执行。参数：任务名称 任务函数 是否持有yum锁 依赖的任务...
+            langs_spawn() {{
+                local name=$1 func=$2 locked=$3 dep slot status
+                shift 3
+                mkdir -p ${{LANGS_JOBS_DIR}}
+                touch ${{LANGS_JOBS_DIR}}/${{name}}.pending
+                (
+                    # 任务的退出码由任务函数返回，不能因errexit提前退出而使任务停留在pending状态
+                    set +e
+                    for dep in "$@"; do
+                        while [ ! -f ${{LANGS_JOBS_DIR}}/${{dep}}.done ]; do
+                            if [ -f ${{LANGS_JOBS_DIR}}/${{dep}}.failed ]; then
+                                echo "--- Skip ${{name}}: ${{dep}} failed"
+                                mv ${{LANGS_JOBS_DIR}}/${{name}}.pending ${{LANGS_JOBS_DIR}}/${{name}}.failed
+                                exit 1
+                            fi
+                            sleep 0.2
+                        done
+                    done
+                    slot=`langs_acquire_slot`
+                    cd {self.__build_root}
+                    if [ 1 -eq ${{locked}} ]; then
+                        ( flock 9; ${{func}} ) 9>${{LANGS_JOBS_DIR}}/yum.lock >${{LANGS_JOBS_DIR}}/${{name}}.log 2>&1
+                    else
+                        ${{func}} >${{LANGS_JOBS_DIR}}/${{name}}.log 2>&1
+                    fi
+                    status=$?
+                    rmdir ${{LANGS_JOBS_DIR}}/slot.${{slot}}
+                    # 每个任务的日志单独保存，完成后整体输出
+                    ( flock 9; echo "--- Job ${{name}} exited with ${{status}}"; cat ${{LANGS_JOBS_DIR}}/${{name}}.log ) 9>${{LANGS_JOBS_DIR}}/output.lock
+                    [ 0 -eq ${{status}} ] && mv ${{LANGS_JOBS_DIR}}/${{name}}.pending ${{LANGS_JOBS_DIR}}/${{name}}.done || mv ${{LANGS_JOBS_DIR}}/${{name}}.pending ${{LANGS_JOBS_DIR}}/${{name}}.failed
+                ) &
+            }}
+
+            # 结束进程及其所有子进程。参数：进程号
+            langs_kill_tree() {{
+                local child
+                for child in `pgrep -P $1`; do
+                    langs_kill_tree ${{child}}
+                done
+                kill $1 2>/dev/null
+            }}
+
+            # 等待所有任务完成，有任务失败时立即结束其他任务
+            langs_wait_jobs() {{
+                local pid
+                while ls ${{LANGS_JOBS_DIR}}/*.pending >/dev/null 2>&1; do
+                    if ls ${{LANGS_JOBS_DIR}}/*.failed >/dev/null 2>&1; then
+                        break
+                    fi
+                    sleep 0.5
+                done
+                if ls ${{LANGS_JOBS_DIR}}/*.failed >/dev/null 2>&1; then
+                    echo "--- Failed jobs: `cd ${{LANGS_JOBS_DIR}} && ls *.failed | xargs`"
+                    for pid in `jobs -p`; do
+                        langs_kill_tree ${{pid}}
+                    done
+                    wait
+                    return 1
+                fi
+                wait
+            }}
+            '''
+            lines.append('\n'.join([ l[12:] if l.startswith(' '*12) else l for l in content_str.split('\n') if l]))
+
+        if self.download_cache:
+            content_str = f'''
+            LANGS_DOWNLOAD_CACHE={self.download_cache}
+            LANGS_DOWNLOAD_CACHE_SIZE={self.__download_cache_size * 1024 * 1024}
+
+            # 从下载缓存取文件，未命中时下载并放入缓存，未完成的下载保留在缓存中供下次续传。参数：缓存键 URL 输出文件 [SHA256]
+            langs_cached_download() {{
+                local entry="${{LANGS_DOWNLOAD_CACHE}}/$1"
+                mkdir -p ${{LANGS_DOWNLOAD_CACHE}}
+                if [ -f "${{entry}}" ]; then
+                    echo "--- Download cache hit: $2"
+                    touch "${{entry}}"
+                else
+                    langs_fetch "$2" "${{entry}}" "$4" || return 1
+                fi
+                cp -f "${{entry}}" "$3"
+            }}
+
+            # 从下载缓存读取文件并输出到标准输出，未命中时边下载边放入缓存。参数：缓存键 URL [SHA256]
+            langs_cached_stream() {{
+                local entry="${{LANGS_DOWNLOAD_CACHE}}/$1"
+                mkdir -p ${{LANGS_DOWNLOAD_CACHE}}
+                if [ -f "${{entry}}" ]; then
+                    echo "--- Download cache hit: $2" >&2
+                    touch "${{entry}}"
+                    cat "${{entry}}"
+                else
+                    ( set -o pipefail; langs_stream "$2" "$3" | tee "${{entry}}.part" ) && mv -f "${{entry}}.part" "${{entry}}" || {{ rm -f "${{entry}}.part"; return 1; }}
+                fi
+            }}
+
+            '''
+            lines.append('\n'.join([ l[12:] if l.startswith(' '*12) else l for l in content_str.split('\n') if l]))
+
+        if self.artifact_cache:
+            content_str = f'''
+            LANGS_ARTIFACT_CACHE={self.artifact_cache}
+            LANGS_ARTIFACT_CACHE_SIZE={self.__artifact_cache_size * 1024 * 1024}
+
+            # 从缓存中恢复编译产物。参数：产物键 安装目录
+            langs_restore_artifact() {{
+                local entry="${{LANGS_ARTIFACT_CACHE}}/$1.tar.gz"
+                [ -f "${{entry}}" ] || return 1
+                echo "--- Artifact cache hit: $1"
+                touch "${{entry}}"
+                rm -rf "$2" && mkdir -p "$2" && tar -xzf "${{entry}}" -C "$2"
+            }}
+
+            # 将安装目录打包保存到缓存中。参数：产物键 安装目录
+            langs_save_artifact() {{
+                local entry="${{LANGS_ARTIFACT_CACHE}}/$1.tar.gz"
+                mkdir -p ${{LANGS_ARTIFACT_CACHE}}
+                tar -czf "${{entry}}.part" -C "$2" . && mv -f "${{entry}}.part" "${{entry}}" || rm -f "${{entry}}.part"
+            }}
+            '''
+            lines.append('\n'.join([ l[12:] if l.startswith(' '*12) else l for l in content_str.split('\n') if l]))
+
+        if self.download_cache or self.artifact_cache:
+            content_str = f'''
+            # 按最近使用时间淘汰缓存，直到缓存大小不超过上限。参数：缓存目录 大小上限
+            langs_evict_cache() {{
+                [ -d $1 ] || return 0
+                local total=`du -sb $1 | cut -f1`
+                for entry in `ls -tr $1`; do
+                    [ ${{total}} -le $2 ] && break
+                    total=$((total - `stat -c %s $1/${{entry}}`))
+                    echo "--- Evict cache: $1/${{entry}}"
+                    rm -f $1/${{entry}}
+                done
+            }}
+            '''
+            lines.append('\n'.join([ l[12:] if l.startswith(' '*12) else l for l in content_str.split('\n') if l]))
+
+        if self.dependency_cache:
+            content_str = f'''
+            LANGS_DEPENDENCY_CACHE={self.dependency_cache}
+
+            # 从缓存中恢复预装的依赖，只复制缺少的文件。参数：类型 目录
+            langs_restore_dependencies() {{
+                [ -d "${{LANGS_DEPENDENCY_CACHE}}/$1" ] || return 0
+                echo "--- Dependency cache hit: $1"
+                mkdir -p "$2" && cp -a -n "${{LANGS_DEPENDENCY_CACHE}}/$1/." "$2/"
+            }}
+
+            # 将预装的依赖保存到缓存中，只复制更新的文件。参数：类型 目录
+            langs_save_dependencies() {{
+                [ -d "$2" ] || return 0
+                mkdir -p "${{LANGS_DEPENDENCY_CACHE}}/$1" && cp -a -u "$2/." "${{LANGS_DEPENDENCY_CACHE}}/$1/"
+            }}
+            '''
+            lines.append('\n'.join([ l[12:] if l.startswith(' '*12) else l for l in content_str.split('\n') if l]))
+
+        if self.ccache:
+            content_str = f'''
+            # 启用ccache，CentOS的基础仓库中没有ccache时从EPEL安装
+            langs_enable_ccache() {{
+                command -v ccache >/dev/null 2>&1 || yum install -y ccache || {{ yum install -y epel-release && yum install -y ccache; }} || return 0
+                export CCACHE_DIR={self.ccache}
+                export CCACHE_MAXSIZE={self.__ccache_size}G
+                # 源码解压在随机的临时目录中，使用相对路径计算缓存键
+                export CCACHE_BASEDIR={self.__build_root}
+                export CCACHE_NOHASHDIR=1
+                export PATH=/usr/lib64/ccache:${{PATH}}
+            }}
+            '''
+            lines.append('\n'.join([ l[12:] if l.startswith(' '*12) else l for l in content_str.split('\n') if l]))
+
+        return '\n'.join(lines)
+
+    def get_script_header(self):
         content_str = f'''
         #!/bin/sh
-        BASH_PROFILE="${{HOME}}/.bashrc"
+        # 任一步骤失败时脚本以非零退出码结束，构建失败，未安装完成的层不会进入构建缓存
+        set -e
 
         #生成目录
         mkdir -p {self.archive_home}
         cd {self.__build_root}
+        '''
+
+        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
+
+        if self.yum_cache:
+            # 保留下载的RPM包，缓存目录通过BuildKit的缓存挂载在多次构建之间保留
+            content_str = '\n'.join([content_str, "grep -q '^keepcache=' /etc/yum.conf && sed -i -e 's/^keepcache=.*/keepcache=1/' /etc/yum.conf || echo 'keepcache=1' >> /etc/yum.conf"])
+
+        # 公共函数中含有缩进，不能再嵌入到模板中处理
+        functions_str = self.get_script_functions()
+        if functions_str:
+            content_str = '\n'.join([content_str, '', functions_str])
+
+        return content_str
 
+    def get_setup_content(self):
         #国内YUM镜像
-        {self.configure_yum_repos()}
-
-        #设置中文环境
-        echo "export LC_ALL=zh_CN.UTF-8"  >> /etc/locale.conf && 
-        yum install -y kde-l10n-Chinese && 
-        yum -y reinstall glibc-common && 
-        localedef -c -f UTF-8 -i zh_CN zh_CN.utf8
-        cat >> ${{BASH_PROFILE}} <<EOF
-
-        # languages
-        export LANG=zh_CN.UTF-8
-        export LANGUAGE=zh_CN:zh
-        export LC_ALL=zh_CN.UTF-8
-        EOF
-        source ${{BASH_PROFILE}}
+        return self.__step(StepDefs.phase, 'yum_repos', self.configure_yum_repos())
 
-        {self.install_softwares()}
+    def get_finish_content(self, groups = None):
+        content_str = f'''
+        # 环境变量
+        {self.get_environment_content(groups)}
 
         # entrypint
-        cat >> {ENTRYPOINT_SCRIPT_PATH} <<EOF
-        #!/bin/sh
-        cat /etc/motd
-        systemctl enable sshd.service
-        exec /usr/sbin/init
-        EOF
-        chmod +x {ENTRYPOINT_SCRIPT_PATH}
+        {self.__step(StepDefs.phase, 'entrypoint', self.__get_entrypoint_content())}
 
         # 安装证书
         # echo -n | \\
@@ -621,42 +1808,352 @@ class ShCoder(object):
         # openssl s_client -showcerts -connect hub.docker.com:443 2>/dev/null | \\
         # sed -ne '/-BEGIN CERTIFICATE-/,/-END CERTIFICATE-/p' > /etc/ssl/certs/docker-hub-certificates.crt
         # update-ca-trust
+        '''
 
-        #清理
-        rm -rf {self.__build_root}
-        yum clean all
+        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
+        return content_str
+
+    def __get_entrypoint_content(self):
+        content_str = f'''
+        cat >> {ENTRYPOINT_SCRIPT_PATH} <<EOF
+        #!/bin/sh
+        cat /etc/motd
+        systemctl enable sshd.service
+        exec /usr/sbin/init
+        EOF
+        chmod +x {ENTRYPOINT_SCRIPT_PATH}
 
-        #结束
-        echo "Finish all"
+        # 轻量的入口：不启动systemd，作为1号进程回收僵尸进程，按需生成主机密钥，运行sshd和{SERVICES_PATH}中声明的服务
+        mkdir -p {SERVICES_PATH}
+        cat > {EntrypointDefs.supervisor.value} <<'EOF'
+        #!/bin/bash
+        cat /etc/motd
+        ls /etc/ssh/ssh_host_*_key >/dev/null 2>&1 || ssh-keygen -A
+        mkdir -p /var/run/sshd
+
+        # 每个服务为一个在前台运行的可执行文件
+        for service in {SERVICES_PATH}/*; do
+            [ -x "${{service}}" ] || continue
+            echo "Start service: ${{service}}"
+            "${{service}}" &
+        done
+
+        /usr/sbin/sshd -D -e &
+        sshd_pid=$!
+
+        trap 'kill -TERM `jobs -p` 2>/dev/null' TERM INT
+        # bash在等待时会回收所有子进程，包括被托管给1号进程的孤儿进程
+        while kill -0 ${{sshd_pid}} 2>/dev/null; do
+            wait ${{sshd_pid}}
+            status=$?
+        done
+        kill -TERM `jobs -p` 2>/dev/null
+        wait
+        exit ${{status:-1}}
+        EOF
+        chmod +x {EntrypointDefs.supervisor.value}
         '''
 
         content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
         return content_str
 
-    def get_dockerfile_content(self):
+    def __clean_yum(self):
+        if self.yum_cache:
+            # 缓存目录是挂载的，不会留在镜像中，只恢复默认的keepcache设置
+            return "sed -i -e 's/^keepcache=.*/keepcache=0/' /etc/yum.conf"
+        return 'yum clean all'
+
+    def get_cleanup_content(self):
+        content_str = f'''
+        cd /
+        rm -rf {self.__build_root}
+        {self.__clean_yum()}
+        {'langs_evict_cache ${LANGS_DOWNLOAD_CACHE} ${LANGS_DOWNLOAD_CACHE_SIZE}' if self.download_cache else ''}
+        {'langs_evict_cache ${LANGS_ARTIFACT_CACHE} ${LANGS_ARTIFACT_CACHE_SIZE}' if self.artifact_cache else ''}
+        '''
+
+        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l.strip()])
+        #清理
+        return self.__step(StepDefs.phase, 'cleanup', content_str)
+
+    def get_software_script_content(self):
+        content_str = '\n'.join([
+            self.get_script_header(),
+            *self.get_environment_lines(),
+            '',
+            self.get_setup_content(),
+            self.get_locale_content(),
+            '',
+            self.install_softwares(),
+            '',
+            self.get_finish_content(),
+            '',
+            self.get_cleanup_content(),
+            '',
+            '#结束',
+            'echo "Finish all"'
+        ])
+        return content_str
+
+    def __fragment_appender(self, fragments):
+        installed = []
+
+        def append_fragment(tag, group, content, stage = None, env_groups = None):
+            # 只导出已安装的组和当前组的环境变量，其他组的变化不影响该层的缓存
+            if group and group not in installed:
+                installed.append(group)
+            fragments.append(ScriptFragment(
+                f'{self.name}-{len(fragments):02d}-{tag}.sh',
+                group,
+                '\n'.join([
+                    self.get_script_header(),
+                    *self.get_environment_lines(list(installed) if env_groups is None else env_groups),
+                    '',
+                    content,
+                    '',
+                    self.get_cleanup_content(),
+                    '',
+                    f'echo "Finish {tag}"'
+                ]),
+                stage
+            ))
+        return append_fragment
+
+    def get_stage_paths(self, g, pkgs):
+        '''多阶段构建时从语言组的编译阶段复制到最终镜像的路径：http安装的目录和配置项paths中的路径
+        '''
+        paths = []
+        for p in pkgs:
+            if InstallDefs.http.name == p.install:
+                paths.append(self.get_home(p))
+            paths.extend([ path for path in (p.paths or '').split() if path not in paths ])
+        return paths
+
+    def get_volumes(self, groups = None):
+        '''依赖缓存的目录，来自配置项volumes，返回（卷名称，路径）；卷名称由路径得到，如langs-m2-repository
+        '''
+        groups = self.__groups if groups is None else groups
+
+        volumes = []
+        gpkgs = self.get_packages()
+        for g in [ g for g in self.__groups if g in groups ]:
+            for p in gpkgs.get(g, []):
+                for path in (p.volumes or '').split():
+                    name = f'{self.name}-{re.sub(r"[^0-9A-Za-z]+", "-", os.path.relpath(path, "/root")).strip("-")}'
+                    if (name, path) not in volumes:
+                        volumes.append((name, path))
+        return volumes
+
+    def __get_volumes_content(self, groups = None):
+        '''在标签中记录依赖缓存的目录，供运行脚本挂载宿主机上共享的目录；指定declare_volumes时同时声明为VOLUME
+        '''
+        volumes = self.get_volumes(groups)
+        if not volumes:
+            return ''
+
+        content_str = f'''
+        LABEL {VOLUMES_LABEL}="{" ".join([ f"{name}={path}" for name, path in volumes ])}"
+        '''
+        if self.__declare_volumes:
+            content_str += f'''
+        VOLUME [ {", ".join([ f'"{path}"' for name, path in volumes ])} ]
+        '''
+        return content_str
+
+    def get_run_script_content(self, image):
+        '''启动容器的脚本，依赖缓存目录挂载Docker的命名卷或LANGS_CACHE_DIR下的目录，同一台主机上的容器共用一份缓存
+        '''
+        volumes_str = '\n'.join([ f'langs_volume {name} {path}' for name, path in self.get_volumes() ])
+
+        content_str = f'''
+        #!/bin/bash
+        # 启动{image}容器，挂载共享的依赖缓存
+        # 用法：$0 [docker run的参数] [-- 命令]，如：$0 -d -p 2222:22 --name workspace1
+        # LANGS_CACHE_DIR为空时使用Docker的命名卷，否则使用该目录下的同名目录；空的缓存首次使用时从镜像中复制预装的依赖
+        LANGS_IMAGE="${{LANGS_IMAGE:-{image}}}"
+        LANGS_CACHE_DIR="${{LANGS_CACHE_DIR:-}}"
+
+        volumes=()
+        langs_volume() {{
+            if [ -z "${{LANGS_CACHE_DIR}}" ]; then
+                volumes+=(-v "$1:$2")
+                return
+            fi
+            local dir="${{LANGS_CACHE_DIR}}/$1"
+            if [ -z "`ls -A "${{dir}}" 2>/dev/null`" ]; then
+                mkdir -p "${{dir}}" || exit 1
+                docker run --rm -v "${{dir}}:/langs-seed" "${{LANGS_IMAGE}}" /bin/sh -c "[ ! -d $2 ] || cp -a $2/. /langs-seed/" >&2 || exit 1
+            fi
+            volumes+=(-v "${{dir}}:$2")
+        }}
+
+        {volumes_str}
+
+        opts=()
+        while [ $# -gt 0 ] && [ "--" != "$1" ]; do
+            opts+=("$1")
+            shift
+        done
+        [ "--" != "$1" ] || shift
+
+        exec docker run "${{volumes[@]}}" "${{opts[@]}}" "${{LANGS_IMAGE}}" "$@"
+        '''
+
+        return '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l.strip()])
+
+    def __get_multistage_fragments(self):
+        '''多阶段构建的脚本片段：基础阶段安装非语言的组，语言组在各自的编译阶段安装，
+        最终镜像中只重新安装语言组的YUM和RPM软件包，其他从编译阶段复制
+        '''
+        fragments = []
+        append_fragment = self.__fragment_appender(fragments)
+
+        gpkgs = self.get_packages()
+        languages = [ g for g in self.__groups if 100 <= GroupDefs[g].value and gpkgs.get(g, None) ]
+
+        bases = [ g for g in self.__groups if g not in languages ]
+
+        append_fragment('setup', None, self.get_setup_content(), 'base')
+        append_fragment('locale', None, self.get_locale_content(), 'base')
+        # 合并全部YUM软件包时每个阶段一个事务，基础阶段只安装非语言组的软件包
+        yum_str = self.install_batched_yum_packages(bases)
+        if yum_str:
+            append_fragment('yum', None, yum_str, 'base')
+        for g in bases:
+            if not gpkgs.get(g, None):
+                continue
+            append_fragment(g, g, self.install_group(g, gpkgs.get(g)), 'base')
+        append_fragment('finish', None, '\n'.join([
+            # 将编译时间加入登录提示
+            'echo "Built in `date "+%Y%m%dT%H%M%S%z"`" >> /etc/motd',
+            self.get_finish_content(bases)
+        ]), 'base', bases)
+
+        for g in languages:
+            pkgs = gpkgs.get(g)
+            # 编译阶段基于base，其他语言组中依赖的软件包（如编译Python需要的gcc和make）只安装在该编译阶段中
+            requires = self.get_required_packages(pkgs)
+            yum_pkgs = [ p for p in requires if InstallDefs.yum.name == p.install ]
+            if YumBatchDefs.all.name == self.__yum_batch:
+                yum_pkgs.extend([ p for p in pkgs if InstallDefs.yum.name == p.install ])
+            lines = [ self.__step(StepDefs.yum, f'build-{g}', self.__batch_yum(g, yum_pkgs)) ]
+            lines.extend([ self.install_package(p) for p in requires if InstallDefs.yum.name != p.install ])
+            lines.append(self.install_group(g, pkgs))
+            append_fragment(f'build-{g}', g, '\n'.join([ l for l in lines if l ]), f'build-{g}', bases + [g])
+
+            # 运行时依赖的其他组的软件包（配置项runtime_requires，如cargo链接需要的gcc），基础阶段已有的不再安装
+            runtimes = [ p for p in self.get_required_packages(pkgs, 'runtime_requires') if p.group not in bases ]
+            lines = [
+                self.__step(StepDefs.yum, g, self.__yum(*[ p for p in runtimes + pkgs if InstallDefs.yum.name == p.install ])),
+                self.__step(StepDefs.package, f'{g}-rpm', self.__rpm(*[ p for p in runtimes + pkgs if InstallDefs.rpm.name == p.install ])),
+                *[ self.install_package(p) for p in runtimes if p.install not in (InstallDefs.yum.name, InstallDefs.rpm.name) ]
+            ]
+            f = getattr(self, f'after_group_{g.replace("-", "_")}', None)
+            if f: lines.append(self.__step(StepDefs.after_group, g, f()))
+            lines = [ l for l in lines if l ]
+            if lines:
+                append_fragment(f'final-{g}', g, '\n'.join(lines), g, bases + [g])
+
+        # 每个最终镜像的环境变量文件，只包含该镜像中的语言
+        for target, groups in [ (g, [g]) for g in languages ] + [ (self.name, languages) ]:
+            append_fragment(f'env-{target}', None, self.get_environment_content(bases + groups), f'env-{target}', bases + groups)
+
+        return fragments
+
+    def get_script_fragments(self):
+        '''生成编译脚本片段
+
+        分层模式下按组生成脚本，每个脚本对应Dockerfile中的一个RUN步骤，
+        仅当某组的脚本内容变化时，才会重新构建该层及其后续的层。
+        '''
+        if self.__multistage:
+            return self.__get_multistage_fragments()
+
+        if not self.__layered:
+            return [ ScriptFragment(f'{self.name}-build.sh', None, self.get_software_script_content()) ]
+
+        fragments = []
+        append_fragment = self.__fragment_appender(fragments)
+
+        append_fragment('setup', None, self.get_setup_content())
+        # 语言环境单独一层，软件包的变化不会重新生成
+        append_fragment('locale', None, self.get_locale_content())
+
+        yum_str = self.install_batched_yum_packages()
+        if yum_str:
+            append_fragment('yum', None, yum_str)
+
+        gpkgs = self.get_packages()
+        for g in self.__groups:
+            pkgs = gpkgs.get(g, None)
+            if not pkgs:
+                continue
+            append_fragment(g, g, self.install_group(g, pkgs))
+
+        append_fragment('finish', None, '\n'.join([
+            # 将编译时间加入登录提示
+            'echo "Built in `date "+%Y%m%dT%H%M%S%z"`" >> /etc/motd',
+            self.get_finish_content()
+        ]))
+
+        return fragments
+
+    def get_dockerfile_content(self, fragments = None):
+        if self.__multistage:
+            return self.__get_multistage_dockerfile_content(fragments or self.get_script_fragments())
+
         language_str = " ".join([ name for name, en in GroupDefs.__members__.items() if 100 <= en.value ])
 
+        mounts_str = ''.join([ f'{m} ' for m in self.get_run_mounts() ])
+
         content_str = f'''
+        {'# syntax=docker/dockerfile:1' if mounts_str else ''}
         FROM {self.get_centos_image_info()}
 
         MAINTAINER {self.maintainer}
 
-        ENV LANG="zh_CN.UTF-8" LC_ALL="zh_CN.UTF-8" LANGUAGE="zh_CN:zh"
+        ENV {self.get_locale_env()}
 
         LABEL description="集合多种开发语言环境" language="{language_str}"
+        '''
+
+        if self.__layered:
+            for fragment in fragments or self.get_script_fragments():
+                content_str += self.__run_fragment(fragment)
 
+            content_str += f'''
+        RUN \\
+            # 设置{os.path.basename(ENTRYPOINT_SCRIPT_PATH)}脚本可用'''
+        else:
+            content_str += f'''
         ARG builder_sh
         ADD ${{builder_sh}} /tmp/
 
-        RUN \\
+        RUN {mounts_str}\\
             # 将编译时间加入登录提示
             echo "Built in `date "+%Y%m%dT%H%M%S%z"`" >> /etc/motd; \\
             # 将环境变量写到/etc/profile里面，保证SSH登录的时候能够正确使用
             # 执行编译脚本
-            sh /tmp/${{builder_sh}}; \\
+            sh /tmp/${{builder_sh}} || exit 1; \\
             # 删除编译脚本
             rm -f /tmp/${{builder_sh}}; \\
-            # 设置{os.path.basename(ENTRYPOINT_SCRIPT_PATH)}脚本可用
+            # 设置{os.path.basename(ENTRYPOINT_SCRIPT_PATH)}脚本可用'''
+
+        content_str += self.__get_systemd_content()
+        content_str += self.__get_volumes_content()
+
+        content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
+        return content_str
+
+    def __run_fragment(self, fragment):
+        mounts_str = ''.join([ f'{m} ' for m in self.get_run_mounts([fragment.group] if fragment.group else []) ])
+        return f'''
+        COPY {fragment.name} /tmp/
+        RUN {mounts_str}sh /tmp/{fragment.name} && rm -f /tmp/{fragment.name}
+        '''
+
+    def __get_systemd_content(self):
+        return f'''
             # chmod 755 {ENTRYPOINT_SCRIPT_PATH}
             (cd /lib/systemd/system/sysinit.target.wants/; \\
             for i in *; do [ $i == systemd-tmpfiles-setup.service ] || rm -f $i; done); \\
@@ -669,59 +2166,1312 @@ class ShCoder(object):
             rm -f /lib/systemd/system/anaconda.target.wants/*;
 
         EXPOSE 22 8080 34433
-
-        VOLUME [ "/sys/fs/cgroup" ]
-
-        CMD ["{ENTRYPOINT_SCRIPT_PATH}"]
+        {'VOLUME [ "/sys/fs/cgroup" ]' if EntrypointDefs.systemd == self.__entrypoint else ''}
+        CMD ["{self.__entrypoint.value}"]
         # CMD ["/usr/sbin/sshd -D"]
         # CMD ["/usr/sbin/init"]
         '''
 
+    def __get_multistage_dockerfile_content(self, fragments):
+        '''多阶段构建的Dockerfile：base为公共阶段，build-<组>为语言组的编译阶段，
+        <组>为单个语言的镜像，最后的{name}阶段包含所有选择的语言，是默认的构建目标
+        '''
+        gpkgs = self.get_packages()
+        languages = [ f.group for f in fragments if f.stage == f'build-{f.group}' ]
+
+        content_str = f'''
+        # syntax=docker/dockerfile:1
+        FROM {self.get_centos_image_info()} AS base
+
+        MAINTAINER {self.maintainer}
+
+        ENV {self.get_locale_env()}
+
+        LABEL description="集合多种开发语言环境" language=""
+        '''
+
+        for fragment in [ f for f in fragments if 'base' == f.stage ]:
+            content_str += self.__run_fragment(fragment)
+
+        content_str += f'''
+        RUN \\
+            # 设置{os.path.basename(ENTRYPOINT_SCRIPT_PATH)}脚本可用'''
+        content_str += self.__get_systemd_content()
+
+        for g in languages:
+            content_str += f'''
+        FROM base AS build-{g}
+        '''
+            for fragment in [ f for f in fragments if f'build-{g}' == f.stage ]:
+                content_str += self.__run_fragment(fragment)
+
+        def install_languages(stage, groups):
+            content_str = f'''
+        FROM base AS {stage}
+        LABEL language="{" ".join(groups)}"
+        '''
+            for g in groups:
+                for path in self.get_stage_paths(g, gpkgs.get(g)):
+                    content_str += f'''
+        COPY --from=build-{g} {path} {path}
+        '''
+                # 编译阶段的分析和大小报告按阶段命名，profile和sizes读取时合并
+                for path in [ PROFILE_PATH ] + ([ SIZE_REPORT_PATH ] if self.__slim else []):
+                    content_str += f'''
+        COPY --from=build-{g} {path} {get_stage_report_path(path, f'build-{g}')}
+        '''
+                for fragment in [ f for f in fragments if g == f.stage ]:
+                    content_str += self.__run_fragment(fragment)
+            for fragment in [ f for f in fragments if f'env-{stage}' == f.stage ]:
+                content_str += self.__run_fragment(fragment)
+            content_str += self.__get_volumes_content(groups)
+            return content_str
+
+        # 单个语言的镜像
+        for g in languages:
+            content_str += install_languages(g, [g])
+
+        # 包含所有语言的镜像，作为默认的构建目标
+        content_str += install_languages(self.name, languages)
+
         content_str = '\n'.join([ l[8:] if l.startswith(' '*8) else l for l in content_str.split('\n') if l])
         return content_str
 
 
-try:
-    coder = ShCoder(None, *[ e for e in GroupDefs.__members__ ])
+FETCH_LOCKS = {}
+
+def fetch_artifact(url, filepath, sha256 = None, retries = 5):
+    '''下载文件，已存在的.part文件会通过Range请求断点续传，失败时按指数退避重试；指定校验和时边下载边校验
+    '''
+    # 并发构建的多个镜像可能下载同一个文件
+    with FETCH_LOCKS.setdefault(os.path.abspath(filepath), threading.Lock()):
+        if os.path.exists(filepath):
+            return filepath
+
+        os.makedirs(os.path.dirname(filepath), exist_ok = True)
+        part_path = f'{filepath}.part'
+
+        # 与编译脚本中的curl -k保持一致
+        context = ssl._create_unverified_context()
+
+        delay = 2
+        for attempt in range(1, retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+            request = urllib.request.Request(url)
+            if offset:
+                request.add_header('Range', f'bytes={offset}-')
+
+            try:
+                with urllib.request.urlopen(request, timeout = 60, context = context) as response:
+                    mode = 'ab' if offset and 206 == response.status else 'wb'
+                    h = hashlib.sha256()
+                    if 'ab' == mode:
+                        with open(part_path, 'rb') as f:
+                            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                                h.update(chunk)
+                    with open(part_path, mode) as f:
+                        for chunk in iter(lambda: response.read(1024 * 1024), b''):
+                            h.update(chunk)
+                            f.write(chunk)
+                    # 连接中断时保留已下载的部分，重试时续传
+                    if response.length:
+                        raise IOError(f'Incomplete download, {response.length} bytes left')
+
+                if not sha256 or h.hexdigest() == sha256.lower():
+                    os.replace(part_path, filepath)
+                    return filepath
+
+                warnings.warn(f'Checksum mismatch: {url}')
+                os.remove(part_path)
+            except urllib.error.HTTPError as e:
+                # 服务器不支持断点续传，下次重新下载；其他HTTP错误不重试
+                if 416 == e.code:
+                    os.remove(part_path)
+                elif e.code < 500:
+                    raise
+            except OSError as e:
+                warnings.warn(f'Download failed ({attempt}/{retries}): {url}: {e}')
+
+            if attempt < retries:
+                time.sleep(delay)
+                delay *= 2
+
+        raise IOError(f'Download failed: {url}')
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def get_prefetch_tasks(coder, prefetch_dir):
+    '''获取http和rpm方式安装的软件包的下载任务，返回软件包名称到（URL，文件路径，校验和）的映射
+    '''
+    tasks = {}
+    for pkgs in coder.get_packages().values():
+        for p in pkgs:
+            if p.install not in (InstallDefs.http.name, InstallDefs.rpm.name) or not p.url:
+                continue
+            url = coder.get_url(p)
+            if not url.startswith('http'):
+                continue
+            tasks.update({ p.name : (url, os.path.join(prefetch_dir, p.group, os.path.basename(url)), p.sha256) })
+    return tasks
+
+def prefetch_artifacts(tasks, workers = 8):
+    '''在宿主机上并发下载软件包，返回软件包名称到文件名的映射
+    '''
+    prefetched = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = { executor.submit(fetch_artifact, url, filepath, sha256) : name for name, (url, filepath, sha256) in tasks.items() }
+        for future in concurrent.futures.as_completed(futures):
+            name = futures.get(future)
+            filepath = future.result()
+            print(f'Prefetched {name}: {filepath}')
+            prefetched.update({ name : os.path.basename(filepath) })
+
+    return prefetched
+
+def get_inputs_hash(dockerfile_content, fragments, target = None, compression = None, compression_level = None):
+    '''计算Dockerfile和编译脚本的内容哈希，多阶段构建时不同的目标使用不同的哈希，镜像层的压缩格式和级别不同时哈希也不同
+    '''
+    h = hashlib.sha256()
+    h.update(f'version={INPUTS_HASH_VERSION}'.encode('utf-8') + b'\0')
+    if target:
+        h.update(f'target={target}'.encode('utf-8') + b'\0')
+    if compression:
+        h.update(f'compression={compression}:{"" if compression_level is None else compression_level}'.encode('utf-8') + b'\0')
+    for name, content in [('Dockerfile', dockerfile_content)] + [ (f.name, f.content) for f in fragments ]:
+        h.update(name.encode('utf-8') + b'\0' + content.encode('utf-8') + b'\0')
+    return h.hexdigest()
+
+def find_image(inputs_hash):
+    '''查找带有相同输入哈希标签的本地镜像；标签只在构建成功时写入，脚本失败的构建不会产生带标签的镜像
+    '''
+    cmdline = ['docker', 'images', '-q', '--filter', f'label={INPUTS_HASH_LABEL}={inputs_hash}']
+    try:
+        ids = subprocess.check_output(cmdline, universal_newlines = True).split()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return ids[0] if ids else None
+
+def probe_mirror(mirror, timeout = 5, rounds = 2, size = 65536):
+    '''测量从镜像下载一个小文件的耗时（秒），取多次中的最小值，失败时返回None
+    '''
+    ctx = ssl._create_unverified_context()
+    best = None
+    for _ in range(rounds):
+        begin = time.monotonic()
+        try:
+            with urllib.request.urlopen(mirror.get_probe_url(), timeout = timeout, context = ctx) as resp:
+                resp.read(size)
+        except (OSError, ValueError):
+            continue
+        elapsed = time.monotonic() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def rank_mirrors(mirrors, timeout = 5, rounds = 2, workers = 16):
+    '''并发测速，返回类型到镜像排名的映射，不可用的镜像不参与排名
+    '''
+    ranking = { e.name : [] for e in MirrorDefs }
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = { executor.submit(probe_mirror, m, timeout, rounds) : m for m in mirrors }
+        for future in concurrent.futures.as_completed(futures):
+            m = futures.get(future)
+            latency = future.result()
+            print(f'Probed {m.kind}/{m.name}: {"unreachable" if latency is None else f"{latency * 1000:.0f}ms"}')
+            if latency is not None:
+                ranking.get(m.kind).append(dict(name = m.name, latency = latency))
+
+    for items in ranking.values():
+        items.sort(key = lambda i: i.get('latency'))
+    return ranking
+
+def get_mirrors_digest(mirrors):
+    '''候选镜像的摘要，候选镜像变化时已保存的排名失效
+    '''
+    content = json.dumps([ m.__dict__ for m in mirrors ], sort_keys = True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def get_mirror_ranking(mirrors, ranking_file = MIRROR_RANKING_PATH, ttl = 86400, refresh = False, **kwargs):
+    '''读取保存的镜像排名，过期或候选镜像变化时重新测速并保存
+    '''
+    digest = get_mirrors_digest(mirrors)
+
+    if not refresh and os.path.exists(ranking_file):
+        try:
+            with open(ranking_file, 'r', encoding = 'utf-8') as f:
+                saved = json.load(f)
+            if saved.get('digest') == digest and time.time() - saved.get('time', 0) < ttl:
+                return saved.get('ranking')
+        except (OSError, ValueError):
+            pass
+
+    ranking = rank_mirrors(mirrors, **kwargs)
+
+    os.makedirs(os.path.dirname(ranking_file) or '.', exist_ok = True)
+    with open(ranking_file + '.part', 'w', encoding = 'utf-8') as f:
+        json.dump(dict(time = time.time(), digest = digest, ranking = ranking), f, indent = 2)
+    os.replace(ranking_file + '.part', ranking_file)
+
+    return ranking
+
+def select_mirrors(args):
+    '''按测速排名为每种类型选择最快的几个镜像；未开启测速时使用候选镜像中的默认镜像，未指定候选镜像文件时返回None使用内置的默认镜像
+    '''
+    if not args.probe_mirrors and not args.mirrors_file:
+        return None
+
+    mirrors = load_mirrors(args.mirrors_file)
+    if not args.probe_mirrors:
+        # 如离线时使用本地替代的镜像，不测速
+        return get_default_mirrors(mirrors)
+
+    ranking = get_mirror_ranking(mirrors, ranking_file = args.mirrors_ranking, ttl = args.mirrors_ttl)
+    named = { m.name : m for m in mirrors }
+
+    return { kind : [ named.get(i.get('name')) for i in items if i.get('name') in named ][:args.mirrors_count] for kind, items in ranking.items() }
+
+def create_coder(args, groups, mirrors = None):
+    coder = ShCoder(
+        args.internal_hub,
+        *groups,
+        layered = args.layered,
+        download_cache = DOWNLOAD_CACHE_PATH if args.download_cache else None,
+        download_cache_size = args.download_cache_size,
+        yum_batch = args.yum_batch,
+        jobs = args.jobs,
+        ccache = CCACHE_PATH if args.ccache else None,
+        ccache_size = args.ccache_size,
+        artifact_cache = ARTIFACT_CACHE_PATH if args.artifact_cache else None,
+        artifact_cache_size = args.artifact_cache_size,
+        stream = args.stream,
+        verbose = args.verbose,
+        parallel = args.parallel,
+        yum_cache = YUM_CACHE_PATH if args.yum_cache else None,
+        mirrors = select_mirrors(args) if mirrors is None else mirrors,
+        fetch_retries = args.retries,
+        slim = args.slim,
+        multistage = args.multistage,
+        entrypoint = args.entrypoint,
+        ldconfig = args.ldconfig,
+        locales = args.locale,
+        dependency_cache = DEPENDENCY_CACHE_PATH if args.dependency_cache else None,
+        declare_volumes = args.declare_volumes
+    )
     coder.load_configuration(PKG_INFO_STR)
+    return coder
+
+async def run_command(cmdline, prefix = None, **kwargs):
+    '''执行命令，指定prefix时为每行输出加上前缀，便于区分并发执行的命令
+    '''
+    if not prefix:
+        proc = await asyncio.create_subprocess_exec(*cmdline, **kwargs)
+        return await proc.wait()
+
+    proc = await asyncio.create_subprocess_exec(*cmdline, stdout = asyncio.subprocess.PIPE, stderr = asyncio.subprocess.STDOUT, **kwargs)
+    async for line in proc.stdout:
+        print(f'[{prefix}] {line.decode("utf-8", "replace").rstrip()}')
+    return await proc.wait()
+
+async def build_image(args, groups, tag, prefix = None):
+    '''构建镜像，返回（退出码，是否跳过构建）
+    '''
+    coder = create_coder(args, groups)
 
     with tempfile.TemporaryDirectory() as build_tmp_dir:
-        with tempfile.NamedTemporaryFile(mode='w+', dir=build_tmp_dir) as dockerfile_f:
-            with tempfile.NamedTemporaryFile(mode='w+', dir=build_tmp_dir) as software_script_f:
-                dockerfile_f.write(coder.get_dockerfile_content())
-                dockerfile_f.flush()
-
-                software_script_f.write(coder.get_software_script_content())
-                software_script_f.flush()
-
-                cmdline = ' '.join([
-                    'docker',
-                    'build',
-                    '--force-rm',
-                    # '--pull',
-                    '--no-cache',
-                    '--build-arg HTTP_PROXY=${HTTP_PROXY}',
-                    '--build-arg HTTPS_PROXY=${HTTPS_PROXY}',
-                    f'--build-arg builder_sh={os.path.basename(software_script_f.name)}',
-                    f'-t {coder.name}:latest',
-                    f'-f {dockerfile_f.name}',
-                    build_tmp_dir
-                ])
-                print(f'Command: {cmdline}')
-                
-                # if subprocess.call(f'docker build {" ".join(cmdline_opts)} .', shell=True):
-                #     print("Build image failed")
-                if subprocess.call(cmdline, shell=True, cwd=build_tmp_dir):
-                    print("Build image failed")
-
-                software_script_f.seek(0)
-                dockerfile_f.seek(0)
-
-                print(coder.get_software_script_content())
-                print(coder.get_dockerfile_content())
-
-    # shutil.rmtree(build_tmp_dir, ignore_errors=True)
-    # os.removedirs(tmpdir)
-except BaseException as e:
-    warnings.warn(e)
+        prefetch_tasks = None
+        if args.prefetch or args.prefetch_dir:
+            # 预下载的文件名由URL决定，先确定映射以渲染编译脚本，需要构建时再下载
+            prefetch_tasks = get_prefetch_tasks(coder, args.prefetch_dir or os.path.join(build_tmp_dir, 'prefetch'))
+            coder.use_prefetched({ name : os.path.basename(filepath) for name, (url, filepath, sha256) in prefetch_tasks.items() })
+
+        # 只渲染一次
+        fragments = coder.get_script_fragments()
+        dockerfile_content = coder.get_dockerfile_content(fragments)
+        inputs_hash = get_inputs_hash(dockerfile_content, fragments, args.target, args.compression, args.compression_level)
+
+        # 导出镜像文件时总是执行构建，未变化的层直接使用构建缓存
+        image_id = None if args.force or args.export else find_image(inputs_hash)
+        if image_id:
+            print(f'{f"[{prefix}] " if prefix else ""}Image {image_id} is up to date ({INPUTS_HASH_LABEL}={inputs_hash})')
+            return await run_command(['docker', 'tag', image_id, tag], prefix), True
+
+        if prefetch_tasks is not None:
+            await asyncio.get_running_loop().run_in_executor(None, prefetch_artifacts, prefetch_tasks, args.prefetch_workers)
+            if args.prefetch_dir:
+                # 预下载目录可以保留下来，作为离线构建的软件包集合
+                shutil.copytree(args.prefetch_dir, os.path.join(build_tmp_dir, 'prefetch'), copy_function = link_or_copy, ignore = shutil.ignore_patterns('*.part'))
+
+        dockerfile_path = os.path.join(build_tmp_dir, 'Dockerfile')
+        with open(dockerfile_path, 'w') as dockerfile_f:
+            dockerfile_f.write(dockerfile_content)
+
+        for fragment in fragments:
+            with open(os.path.join(build_tmp_dir, fragment.name), 'w') as software_script_f:
+                software_script_f.write(fragment.content)
+
+        cmdline = [
+            'docker',
+            *(['buildx', 'build', *get_output_arguments(args, tag)] if args.compression or args.export else ['build']),
+            '--force-rm',
+            # '--pull',
+            *(['--no-cache'] if args.no_cache else []),
+            # 不指定值时使用当前环境变量的值
+            '--build-arg', 'HTTP_PROXY',
+            '--build-arg', 'HTTPS_PROXY',
+            *([] if args.layered or args.multistage else ['--build-arg', f'builder_sh={fragments[0].name}']),
+            *(['--target', args.target] if args.target else []),
+            '--label', f'{INPUTS_HASH_LABEL}={inputs_hash}',
+            '-t', tag,
+            '-f', dockerfile_path,
+            build_tmp_dir
+        ]
+        print(f'{f"[{prefix}] " if prefix else ""}Command: {" ".join(cmdline)}')
+
+        env = dict(os.environ)
+        if coder.get_run_mounts() or args.compression or args.export:
+            # 缓存挂载需要BuildKit
+            env.update(DOCKER_BUILDKIT = '1')
+
+        status = await run_command(cmdline, prefix, cwd = build_tmp_dir, env = env)
+        if status:
+            print(f"Build image {tag} failed")
+        if prefix:
+            return status, False
+
+        for fragment in fragments:
+            print(fragment.content)
+        print(dockerfile_content)
+
+    return status, False
+
+def get_output_arguments(args, tag):
+    '''buildx的输出参数：按指定的格式重新压缩所有层（包括基础镜像的层），使用OCI媒体类型；
+    指定导出文件时输出OCI格式的镜像文件，用于离线的主机，否则加载到本地的Docker中
+    '''
+    # 镜像名称由-t参数指定
+    attrs = []
+    if args.compression:
+        attrs.extend([ f'compression={args.compression}', 'force-compression=true', 'oci-mediatypes=true' ])
+        if args.compression_level is not None:
+            attrs.append(f'compression-level={args.compression_level}')
+
+    if args.export:
+        dest = args.export.format(tag = re.sub(r'[^0-9A-Za-z_.-]+', '-', tag))
+        return [ '--output', ','.join([ 'type=oci', f'dest={dest}', *attrs ]) ]
+    return [ '--output', ','.join([ 'type=docker', *attrs ]) ]
+
+def build(args):
+    status, _ = asyncio.run(build_image(args, [ e for e in GroupDefs.__members__ ], args.tag or 'langs:latest'))
+    return status
+
+def get_variant_groups(variant):
+    '''解析构建矩阵中的组合，如cpp+python；基础的组（ssh、common、tool）总是按相同的顺序排在语言之前，各组合才能共用基础的层
+    '''
+    names = [ n for n in variant.split('+') if n ]
+    for n in names:
+        if n not in GroupDefs.__members__:
+            raise ValueError(f'Unknown group {n} in variant {variant}')
+    return [ name for name, en in GroupDefs.__members__.items() if en.value < 100 ] + [ name for name, en in GroupDefs.__members__.items() if en.value > 100 and name in names ]
+
+def matrix(args):
+    # 分层构建，各组合共用基础的层
+    args.layered = True
+    name = args.name or 'langs'
+    variants = [ (v, get_variant_groups(v), f'{name}:{v.replace("+", "-")}') for v in args.variants ]
+
+    async def run_matrix():
+        results = []
+
+        # 先构建只包含基础组的镜像，其他组合可以直接复用这些层
+        start = time.monotonic()
+        base_groups = get_variant_groups('')
+        status, skipped = await build_image(args, base_groups, f'{name}:base', 'base')
+        results.append(('base', f'{name}:base', time.monotonic() - start, status, skipped))
+        if status:
+            return results
+
+        semaphore = asyncio.Semaphore(args.workers)
+
+        async def run_variant(variant, groups, tag):
+            async with semaphore:
+                start = time.monotonic()
+                status, skipped = await build_image(args, groups, tag, variant)
+                return (variant, tag, time.monotonic() - start, status, skipped)
+
+        results.extend(await asyncio.gather(*[ run_variant(*v) for v in variants ]))
+        return results
+
+    results = asyncio.run(run_matrix())
+
+    print(f'{"Variant":<24} {"Image":<32} {"Time":>10}  Result')
+    for variant, tag, elapsed, status, skipped in results:
+        result = 'failed' if status else ('up to date' if skipped else 'built')
+        print(f'{variant:<24} {tag:<32} {elapsed:>9.1f}s  {result}')
+
+    return 1 if any([ r[3] for r in results ]) else 0
+
+
+
+class ArtifactProxy(object):
+    '''本地缓存的软件包代理，为internal_hub提供服务
+
+    请求路径为/<软件包名称>/<上游路径>，未命中时从上游下载并保存到磁盘，按LRU淘汰；
+    同一文件的并发请求共用一次上游下载，支持Range请求以便断点续传。
+    未命中的GET请求边下载边以分块编码发送，Range和HEAD请求等待下载完成。
+    '''
+    def __init__(self, upstreams, cache_dir, cache_size = 20480):
+        self.__upstreams = upstreams
+        self.__cache_dir = cache_dir
+        self.__cache_size = cache_size * 1024 * 1024
+        self.__fetching = {}
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def get_upstream_url(self, path):
+        name, _, rest = path.lstrip('/').partition('/')
+        upstream = self.__upstreams.get(name)
+        if not upstream or not rest:
+            return None
+        return f'{upstream.rstrip("/")}/{rest}'
+
+    def get_cache_path(self, url):
+        return os.path.join(self.__cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def evict(self, keep = None):
+        '''按最近使用时间淘汰缓存，直到缓存大小不超过上限，keep为正在使用的文件
+        '''
+        entries = []
+        for name in os.listdir(self.__cache_dir):
+            path = os.path.join(self.__cache_dir, name)
+            if name.endswith('.part') or path == keep or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum([ e[1] for e in entries ])
+        for mtime, size, path in sorted(entries):
+            if total <= self.__cache_size:
+                break
+            print(f'Evict {path}')
+            os.remove(path)
+            total -= size
+
+    def download(self, url, path):
+        fetch_artifact(url, path)
+        self.evict(path)
+        return path
+
+    def get_fetch_task(self, url):
+        '''获取下载任务，同一URL的并发请求共用一个任务
+        '''
+        task = self.__fetching.get(url)
+        if not task:
+            task = asyncio.ensure_future(asyncio.get_running_loop().run_in_executor(None, self.download, url, self.get_cache_path(url)))
+            self.__fetching.update({ url : task })
+            task.add_done_callback(lambda t: self.__fetching.pop(url, None))
+        return task
+
+    async def fetch(self, url):
+        '''获取缓存文件的路径，同一URL的并发请求等待同一个下载任务
+        '''
+        path = self.get_cache_path(url)
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+        return await asyncio.shield(self.get_fetch_task(url))
+
+    def get_part_size(self, path):
+        try:
+            return os.path.getsize(f'{path}.part')
+        except OSError:
+            return 0
+
+    def read_part(self, path, offset):
+        '''从offset读取下载中的文件，下载完成后.part文件被重命名为缓存文件；每次重新打开，重新下载时不会读到已删除的文件
+        '''
+        for source in (path, f'{path}.part'):
+            try:
+                with open(source, 'rb') as f:
+                    f.seek(offset)
+                    return f.read(1024 * 1024)
+            except FileNotFoundError:
+                continue
+        return b''
+
+    async def stream(self, writer, task, path):
+        '''边下载边以分块编码发送；下载失败时不发送结束块直接断开，客户端可以发现文件不完整并重试
+        '''
+        await self.respond(writer, 200, 'OK', { 'Content-Type' : 'application/octet-stream', 'Transfer-Encoding' : 'chunked' })
+        sent = 0
+        while True:
+            done = task.done()
+            chunk = self.read_part(path, sent)
+            if chunk:
+                writer.write(f'{len(chunk):x}\r\n'.encode('latin-1'))
+                await self.send(writer, chunk)
+                writer.write(b'\r\n')
+                sent += len(chunk)
+            elif not done:
+                await asyncio.wait([ task ], timeout = 0.1)
+            elif task.exception() or not os.path.exists(path):
+                print(f'Stream {path} aborted after {sent} bytes: {task.exception()}')
+                return
+            else:
+                writer.write(b'0\r\n\r\n')
+                await writer.drain()
+                return
+
+    async def respond(self, writer, status, reason, headers = None, body = b''):
+        lines = [ f'HTTP/1.1 {status} {reason}' ]
+        lines.extend([ f'{k}: {v}' for k, v in (headers or {}).items() ])
+        lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def send(self, writer, chunk):
+        writer.write(chunk)
+        await writer.drain()
+
+    def parse_range(self, value, size):
+        '''解析单个bytes区间，返回（起始，结束）；无法满足时返回None
+        '''
+        m = re.match(r'^bytes=(\d*)-(\d*)$', value.strip())
+        if not m or not (m.group(1) or m.group(2)):
+            return None
+        if not m.group(1):
+            start, end = max(0, size - int(m.group(2))), size - 1
+        else:
+            start = int(m.group(1))
+            end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+        if start > end or start >= size:
+            return None
+        return start, end
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                k, _, v = line.partition(':')
+                headers.update({ k.strip().lower() : v.strip() })
+
+            parts = request_line.split()
+            if len(parts) < 2 or parts[0] not in ('GET', 'HEAD'):
+                return await self.respond(writer, 405, 'Method Not Allowed')
+
+            method, path = parts[0], parse.urlparse(parts[1]).path
+            url = self.get_upstream_url(path)
+            if not url:
+                return await self.respond(writer, 404, 'Not Found')
+
+            path = self.get_cache_path(url)
+            task = None
+            try:
+                if 'GET' == method and 'range' not in headers and not os.path.exists(path):
+                    # 等待上游的第一块数据，下载在此之前失败时仍返回对应的错误
+                    task = self.get_fetch_task(url)
+                    while not task.done() and not self.get_part_size(path):
+                        await asyncio.wait([ task ], timeout = 0.1)
+                    if not task.done():
+                        return await self.stream(writer, task, path)
+                filepath = task.result() if task else await self.fetch(url)
+            except urllib.error.HTTPError as e:
+                print(f'Fetch {url} failed: {e}')
+                return await self.respond(writer, e.code, e.reason)
+            except Exception as e:
+                print(f'Fetch {url} failed: {e}')
+                return await self.respond(writer, 502, 'Bad Gateway')
+
+            size = os.path.getsize(filepath)
+            start, end = 0, size - 1
+            status, reason = 200, 'OK'
+            response_headers = { 'Content-Type' : 'application/octet-stream', 'Accept-Ranges' : 'bytes' }
+            if 'range' in headers:
+                r = self.parse_range(headers.get('range'), size)
+                if not r:
+                    return await self.respond(writer, 416, 'Range Not Satisfiable', { 'Content-Range' : f'bytes */{size}' })
+                start, end = r
+                status, reason = 206, 'Partial Content'
+                response_headers.update({ 'Content-Range' : f'bytes {start}-{end}/{size}' })
+            response_headers.update({ 'Content-Length' : end - start + 1 if size else 0 })
+
+            await self.respond(writer, status, reason, response_headers)
+            if 'HEAD' == method or not size:
+                return
+
+            with open(filepath, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    await self.send(writer, chunk)
+                    remaining -= len(chunk)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Serving on {", ".join([ str(sock.getsockname()) for sock in server.sockets ])}')
+        async with server:
+            await server.serve_forever()
+
+class SimulatedHub(ArtifactProxy):
+    '''模拟的软件包仓库，作为internal_hub的地址，按请求路径中的后缀生成对应格式的假软件包
+
+    每个响应先等待latency秒，按bandwidth（字节/秒）限速，并统计发送的字节数；
+    压缩包中是可以正常安装的最小内容：configure和Makefile、install.sh、bin目录中的空命令，以及填充的随机数据。
+    '''
+    def __init__(self, cache_dir, latency = 0.05, bandwidth = 10 * 1024 * 1024, archive_size = 1024 * 1024, compile_delay = 0):
+        super().__init__({}, cache_dir, 1024 * 1024)
+        self.__latency = latency
+        self.__bandwidth = bandwidth
+        self.__archive_size = archive_size
+        self.__compile_delay = compile_delay
+        self.sent_bytes = 0
+        self.port = None
+
+    def get_upstream_url(self, path):
+        return f'sim://{path.lstrip("/")}' if '/' in path.lstrip('/') else None
+
+    def get_archive_files(self):
+        '''压缩包中的文件，返回（路径，内容，权限）
+        '''
+        stub = '#!/bin/sh\nexit 0\n'
+        configure = f'''#!/bin/sh
+        prefix=/usr/local
+        for a in "$@"; do case "$a" in --prefix=*) prefix="${{a#--prefix=}}" ;; esac; done
+        printf 'all:\\n\\tsleep {self.__compile_delay} && touch all\\ninstall: all\\n\\tmkdir -p %s/bin %s/lib\\n\\tcp -r bin/. %s/bin/\\n' "$prefix" "$prefix" "$prefix" > Makefile
+        '''
+        install = '''#!/bin/sh
+        for a in "$@"; do case "$a" in --prefix=*) prefix="${a#--prefix=}" ;; esac; done
+        mkdir -p "${prefix:?}/bin" "${prefix}/lib" && cp -r bin/. "${prefix}/bin/"
+        '''
+        files = [
+            ('configure', '\n'.join([ l.strip() for l in configure.split('\n') ]), 0o755),
+            ('install.sh', '\n'.join([ l.strip() for l in install.split('\n') ]), 0o755),
+            ('padding.bin', os.urandom(self.__archive_size), 0o644)
+        ]
+        for name in ('python3', 'pip3', 'node', 'npm', 'go', 'cmake', 'rustc', 'cargo'):
+            files.append((f'bin/{name}', stub, 0o755))
+        return files
+
+    def get_installer(self):
+        '''未压缩的文件作为安装程序（如rustup-init），在~/.cargo/bin中生成空命令，后面填充随机数据
+        '''
+        content_str = '''#!/bin/sh
+        mkdir -p "${HOME}/.cargo/bin"
+        for name in rustup cargo rustc; do printf '#!/bin/sh\\nexit 0\\n' > "${HOME}/.cargo/bin/${name}" && chmod 755 "${HOME}/.cargo/bin/${name}"; done
+        exit 0
+        '''
+        return '\n'.join([ l.strip() for l in content_str.split('\n') if l.strip() ]).encode('utf-8') + b'\n' + os.urandom(self.__archive_size)
+
+    def download(self, url, path):
+        '''生成假的软件包，YUM镜像的.repo文件为一个空的仓库
+        '''
+        name, _, rest = url[6:].partition('/')
+        filename = os.path.basename(rest)
+        compression = ([ e for e in CompressionDefs if filename.endswith(e.value) ] + [ None ])[0]
+
+        if filename.endswith('.repo'):
+            content = f'[{name}]\nname={name}\nbaseurl=http://127.0.0.1:{self.port}/{name}/\nenabled=1\ngpgcheck=0\n'.encode('utf-8')
+        elif compression is None:
+            content = self.get_installer()
+        elif compression in (CompressionDefs.RPM, CompressionDefs.Z):
+            content = os.urandom(self.__archive_size)
+        elif CompressionDefs.ZIP == compression:
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, 'w') as z:
+                for n, c, mode in self.get_archive_files():
+                    info = zipfile.ZipInfo(f'{name}-sim/{n}')
+                    info.external_attr = mode << 16
+                    z.writestr(info, c)
+            content = buf.getvalue()
+        else:
+            buf = io.BytesIO()
+            with tarfile.open(fileobj = buf, mode = 'w') as t:
+                for n, c, mode in self.get_archive_files():
+                    data = c.encode('utf-8') if isinstance(c, str) else c
+                    info = tarfile.TarInfo(f'{name}-sim/{n}')
+                    info.size, info.mode, info.mtime = len(data), mode, time.time()
+                    t.addfile(info, io.BytesIO(data))
+            content = buf.getvalue()
+            if compression in (CompressionDefs.GZ,):
+                content = gzip.compress(content, 1)
+            elif compression in (CompressionDefs.BZ, CompressionDefs.BZ2):
+                content = bz2.compress(content, 1)
+            elif CompressionDefs.XZ == compression:
+                content = lzma.compress(content, preset = 0)
+            elif CompressionDefs.ZST == compression:
+                content = subprocess.run(['zstd', '-q', '-c'], input = content, stdout = subprocess.PIPE, check = True).stdout
+
+        with open(f'{path}.part', 'wb') as f:
+            f.write(content)
+        os.replace(f'{path}.part', path)
+        return path
+
+    async def respond(self, writer, status, reason, headers = None, body = b''):
+        await asyncio.sleep(self.__latency)
+        await super().respond(writer, status, reason, headers, body)
+
+    async def send(self, writer, chunk):
+        for i in range(0, len(chunk), 64 * 1024):
+            part = chunk[i:i + 64 * 1024]
+            await super().send(writer, part)
+            self.sent_bytes += len(part)
+            if self.__bandwidth:
+                await asyncio.sleep(len(part) / self.__bandwidth)
+
+    def start(self):
+        '''在后台线程中运行，监听本机的随机端口
+        '''
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(self.handle, '127.0.0.1', 0))
+        self.port = server.sockets[0].getsockname()[1]
+        threading.Thread(target = loop.run_forever, daemon = True).start()
+        return f'http://127.0.0.1:{self.port}'
+
+def get_upstreams(coder):
+    '''从软件包配置中获取每个软件包上游的地址
+    '''
+    upstreams = {}
+    for pkgs in coder.get_packages().values():
+        for p in pkgs:
+            if not p.url:
+                continue
+            parsed = parse.urlparse(p.url.format(name = p.name, version = p.version))
+            if parsed.scheme in ('http', 'https'):
+                upstreams.update({ p.name : f'{parsed.scheme}://{parsed.netloc}' })
+    return upstreams
+
+def proxy(args):
+    coder = ShCoder(None, *[ e for e in GroupDefs.__members__ ])
+    coder.load_configuration(PKG_INFO_STR)
+
+    upstreams = get_upstreams(coder)
+    for item in args.upstream or []:
+        name, _, url = item.partition('=')
+        upstreams.update({ name : url })
+
+    host, _, port = args.listen.rpartition(':')
+    asyncio.run(ArtifactProxy(upstreams, args.cache_dir, args.cache_size).serve(host or '0.0.0.0', int(port)))
+    return 0
+
+def get_stage_report_path(path, stage):
+    '''多阶段构建中编译阶段报告在最终镜像中的路径，如/var/lib/langs/build-profile.build-rust.jsonl
+    '''
+    root, ext = os.path.splitext(path)
+    return f'{root}.{stage}{ext}'
+
+def read_report(args, path):
+    '''读取镜像中的报告，包括多阶段构建中各编译阶段的报告；编译阶段继承自基础阶段的记录只保留一条
+    '''
+    if args.file:
+        with open(args.file) as f:
+            content = f.read()
+    else:
+        root, ext = os.path.splitext(path)
+        content = subprocess.check_output(['docker', 'run', '--rm', args.image, 'sh', '-c', f'cat {root}*{ext} 2>/dev/null || true'], universal_newlines = True)
+
+    lines = [ l for l in content.splitlines() if l.strip() ]
+    return '\n'.join(sorted(set(lines), key = lines.index))
+
+def load_profile(content):
+    '''读取编译分析文件，计算每个步骤的耗时
+    '''
+    steps = [ json.loads(l) for l in content.splitlines() if l.strip() ]
+    for step in steps:
+        step.update(duration = round(step.get('end') - step.get('start'), 2))
+    return steps
+
+def profile(args):
+    steps = load_profile(read_report(args, PROFILE_PATH))
+    if not steps:
+        print("No profile found")
+        return 1
+
+    total = max([ s.get('end') for s in steps ]) - min([ s.get('start') for s in steps ])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(total = round(total, 2), steps = steps), f, indent = 2, ensure_ascii = False)
+
+    hot_steps = sorted([ s for s in steps if not args.kind or s.get('kind') in args.kind ], key = lambda s: s.get('duration'), reverse = True)
+    print(f'Total: {total:.2f}s')
+    for s in hot_steps[:args.top]:
+        percent = 100 * s.get('duration') / total if total else 0
+        status = '' if not s.get('status') else f'  (exit {s.get("status")})'
+        print(f'{s.get("duration"):>9.2f}s {percent:>5.1f}%  {s.get("kind"):<12} {s.get("name")}{status}')
+
+    return 0
+
+def sizes(args):
+    packages = [ json.loads(l) for l in read_report(args, SIZE_REPORT_PATH).splitlines() ]
+    if not packages:
+        print("No size report found, build with --slim")
+        return 1
+
+    groups = {}
+    for p in packages:
+        g = groups.setdefault(p.get('group'), dict(group = p.get('group'), added = 0, reclaimed = 0))
+        g.update(added = g.get('added') + p.get('added'), reclaimed = g.get('reclaimed') + p.get('reclaimed'))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(groups = list(groups.values()), packages = packages), f, indent = 2, ensure_ascii = False)
+
+    mb = lambda n: n / 1024 / 1024
+    print(f'{"group":<12}{"added":>12}{"reclaimed":>12}')
+    for g in sorted(groups.values(), key = lambda g: g.get('added'), reverse = True):
+        print(f'{g.get("group"):<12}{mb(g.get("added")):>10.1f}MB{mb(g.get("reclaimed")):>10.1f}MB')
+        for p in sorted([ p for p in packages if p.get('group') == g.get('group') ], key = lambda p: p.get('added'), reverse = True):
+            print(f'  {p.get("name"):<10}{mb(p.get("added")):>10.1f}MB{mb(p.get("reclaimed")):>10.1f}MB')
+
+    return 0
+
+def wait_ssh_banner(port, timeout):
+    '''等待sshd输出版本信息，返回是否成功
+    '''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout = 1) as sock:
+                if sock.recv(4).startswith(b'SSH-'):
+                    return True
+        except OSError:
+            pass
+        time.sleep(0.05)
+    return False
+
+def measure_cold_start(image, entrypoint, timeout = 60, run_args = None):
+    '''启动容器并计时，直到可以通过SSH连接，返回耗时（秒），超时返回None
+    '''
+    cmdline = ['docker', 'run', '-d', '-p', '127.0.0.1::22', *(run_args or [])]
+    if EntrypointDefs.systemd == entrypoint:
+        # systemd需要cgroup和/run
+        cmdline.extend(['-v', '/sys/fs/cgroup:/sys/fs/cgroup:ro', '--tmpfs', '/run'])
+
+    begin = time.monotonic()
+    container = subprocess.check_output(cmdline + [image, entrypoint.value], universal_newlines = True).strip()
+    try:
+        port = subprocess.check_output(['docker', 'port', container, '22/tcp'], universal_newlines = True).split(':')[-1].strip()
+        if not wait_ssh_banner(int(port), timeout):
+            return None
+        return time.monotonic() - begin
+    finally:
+        subprocess.call(['docker', 'rm', '-f', container], stdout = subprocess.DEVNULL)
+
+def bench(args):
+    results = {}
+    for name in args.entrypoint or [ e for e in EntrypointDefs.__members__ ]:
+        durations = []
+        for i in range(args.runs):
+            duration = measure_cold_start(args.image, EntrypointDefs[name], args.timeout, args.run_arg)
+            print(f'{name} #{i + 1}: {"timeout" if duration is None else f"{duration:.2f}s"}')
+            if duration is not None:
+                durations.append(duration)
+        results.update({ name : durations })
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+    print(f'{"entrypoint":<12}{"min":>8}{"median":>8}{"max":>8}')
+    for name, durations in results.items():
+        if not durations:
+            print(f'{name:<12}{"-":>8}{"-":>8}{"-":>8}')
+            continue
+        durations = sorted(durations)
+        print(f'{name:<12}{durations[0]:>7.2f}s{durations[len(durations) // 2]:>7.2f}s{durations[-1]:>7.2f}s')
+
+    return 0 if all(results.values()) else 1
+
+def get_simulation_stubs(yum_delay = 1, yum_package_delay = 0.2, rpm_size = 1024 * 1024):
+    '''模拟构建时替换的系统命令，返回命令名称到脚本内容的映射
+
+    yum的每个事务固定耗时，每个软件包另外耗时并写入rpm_size字节，合并事务的效果可以体现在总耗时中。
+    '''
+    yum = f'''
+    #!/bin/bash
+    pkgs=()
+    for a in "$@"; do
+        case "$a" in
+            -*|install|reinstall|makecache|fast|clean|all) ;;
+            *) pkgs+=("$a") ;;
+        esac
+    done
+    case " $* " in
+        *" install "*|*" reinstall "*) ;;
+        *" makecache "*) sleep {yum_delay}; exit 0 ;;
+        *) exit 0 ;;
+    esac
+    sleep `awk "BEGIN {{ print {yum_delay} + ${{#pkgs[@]}} * {yum_package_delay} }}"`
+    mkdir -p /var/lib/langs-sim/rpms
+    for p in "${{pkgs[@]}}"; do head -c {rpm_size} /dev/zero > "/var/lib/langs-sim/rpms/${{p}}"; done
+    '''
+    rpm = f'''
+    #!/bin/bash
+    if [ "-qa" = "$1" ]; then
+        for f in /var/lib/langs-sim/rpms/*; do [ ! -f "$f" ] || stat -c %s "$f"; done
+        exit 0
+    fi
+    for a in "$@"; do
+        case "$a" in
+            -*) ;;
+            *) [ -f "$a" ] || {{ echo "rpm: $a: No such file" >&2; exit 1; }} ;;
+        esac
+    done
+    sleep {yum_package_delay}
+    '''
+    stubs = dict(yum = yum, rpm = rpm)
+    for name in ('localedef', 'ssh-keygen', 'chpasswd', 'systemctl', 'mvn'):
+        stubs.update({ name : '#!/bin/sh\nexit 0\n' })
+    return { name : '\n'.join([ l[4:] if l.startswith(' '*4) else l for l in content.split('\n') if l.strip() ]) + '\n' for name, content in stubs.items() }
+
+def parse_run_mounts(mounts):
+    '''解析RUN步骤的挂载参数，返回（类型，缓存id或构建上下文中的路径，目标路径）
+    '''
+    result = []
+    for m in mounts:
+        d = dict([ kv.partition('=')[::2] for kv in m[len('--mount='):].split(',') ])
+        result.append((d.get('type'), d.get('id') or d.get('source'), d.get('target')))
+    return result
+
+def simulate_build(coder, workdir, stub_dir, cache_dir, context_dir, poll_interval = 0.05):
+    '''在沙箱中依次执行编译脚本片段，返回耗时、磁盘用量和编译分析
+
+    沙箱为新的挂载命名空间中以根目录为下层的overlay，上层为tmpfs，写入的内容即镜像层的内容，
+    用tmpfs的已用空间统计磁盘峰值；缓存挂载对应workdir中的目录，多次执行时保留，与BuildKit的缓存挂载一致。
+    '''
+    run_dir = tempfile.mkdtemp(dir = workdir, prefix = 'run-')
+    script_dir, up_dir, root_dir = [ os.path.join(run_dir, d) for d in ('scripts', 'up', 'root') ]
+    os.makedirs(script_dir)
+
+    fragments = coder.get_script_fragments()
+    for fragment in fragments:
+        with open(os.path.join(script_dir, fragment.name), 'w') as f:
+            f.write(fragment.content)
+
+    binds = []
+    for kind, name, target in parse_run_mounts(coder.get_run_mounts()):
+        source = os.path.join(cache_dir, name) if 'cache' == kind else os.path.join(context_dir, name)
+        os.makedirs(source, exist_ok = True)
+        binds.append(f'mkdir -p {root_dir}{target} && mount --bind {source} {root_dir}{target}')
+
+    # CentOS中sh为bash，这里直接使用bash执行
+    run_lines = [ f'''
+    start=`cut -d ' ' -f 1 /proc/uptime`
+    chroot {root_dir} /usr/bin/env -i HOME=/root PATH=/opt/langs-sim/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin bash /tmp/langs-sim/{fragment.name} > {run_dir}/{fragment.name}.log 2>&1
+    status=$?
+    echo "{fragment.name} ${{start}} `cut -d ' ' -f 1 /proc/uptime` ${{status}}" >> {run_dir}/fragments
+    ''' for fragment in fragments ]
+
+    content_str = f'''
+    set -e
+    mkdir -p {up_dir} {root_dir}
+    mount -t tmpfs tmpfs {up_dir}
+    mkdir -p {up_dir}/upper {up_dir}/work
+    mount -t overlay overlay -o lowerdir=/,upperdir={up_dir}/upper,workdir={up_dir}/work {root_dir}
+    mount --rbind /dev {root_dir}/dev
+    mount --rbind /proc {root_dir}/proc
+    mkdir -p {root_dir}/opt/langs-sim/bin {root_dir}/tmp/langs-sim
+    mount --bind {stub_dir} {root_dir}/opt/langs-sim/bin
+    mount --bind {script_dir} {root_dir}/tmp/langs-sim
+    {(chr(10) + '    ').join(binds)}
+    # 宿主机不是CentOS时补齐脚本修改的目录和文件
+    mkdir -p {root_dir}/etc/yum.repos.d {root_dir}/etc/ssh && touch {root_dir}/etc/ssh/sshd_config
+    touch {run_dir}/ready
+    set +e
+    {''.join(run_lines)}
+    cp {root_dir}{PROFILE_PATH} {run_dir}/profile.jsonl 2>/dev/null
+    cp {root_dir}{SIZE_REPORT_PATH} {run_dir}/size-report.jsonl 2>/dev/null
+    stat -f -c '%b %f %S' {up_dir} > {run_dir}/disk
+    '''
+    driver = os.path.join(run_dir, 'driver.sh')
+    with open(driver, 'w') as f:
+        f.write('\n'.join([ l[4:] if l.startswith(' '*4) else l for l in content_str.split('\n') if l.strip() ]) + '\n')
+
+    # 非root用户在新的用户命名空间中映射为root
+    cmdline = ['unshare', '-m', '--propagation', 'private', *([] if 0 == os.geteuid() else ['-r']), 'bash', driver]
+    proc = subprocess.Popen(cmdline)
+
+    baseline, peak = None, 0
+    while proc.poll() is None:
+        if os.path.exists(os.path.join(run_dir, 'ready')):
+            try:
+                st = os.statvfs(f'/proc/{proc.pid}/root{up_dir}')
+                used = (st.f_blocks - st.f_bfree) * st.f_frsize
+                baseline = used if baseline is None else baseline
+                peak = max(peak, used - baseline)
+            except OSError:
+                pass
+        time.sleep(poll_interval)
+    if proc.returncode:
+        raise RuntimeError(f'Sandbox failed with exit {proc.returncode}, see {driver}')
+
+    final = 0
+    if os.path.exists(os.path.join(run_dir, 'disk')):
+        with open(os.path.join(run_dir, 'disk')) as f:
+            blocks, free, size = [ int(n) for n in f.read().split() ]
+        final = max(0, (blocks - free) * size - (baseline or 0))
+
+    results = []
+    with open(os.path.join(run_dir, 'fragments')) as f:
+        for line in f:
+            name, start, end, status = line.split()
+            results.append(dict(name = name, duration = round(float(end) - float(start), 2), status = int(status), log = os.path.join(run_dir, f'{name}.log')))
+
+    steps = []
+    if os.path.exists(os.path.join(run_dir, 'profile.jsonl')):
+        with open(os.path.join(run_dir, 'profile.jsonl')) as f:
+            steps = load_profile(f.read())
+
+    return dict(
+        wall = round(sum([ r.get('duration') for r in results ]), 2),
+        disk_peak = max(peak, final),
+        disk_final = final,
+        fragments = results,
+        steps = steps
+    )
+
+def simulate(args):
+    groups = get_variant_groups(args.variant) if args.variant else [ e for e in GroupDefs.__members__ ]
+    mode_parser = argparse.ArgumentParser(prog = 'langs simulate --mode')
+    add_build_arguments(mode_parser)
+
+    workdir = tempfile.mkdtemp(prefix = 'langs-sim-')
+    hub = SimulatedHub(os.path.join(workdir, 'hub'), args.latency / 1000, args.bandwidth * 1024, args.archive_size * 1024, args.compile_delay)
+    hub_url = hub.start()
+
+    stub_dir = os.path.join(workdir, 'stubs')
+    os.makedirs(stub_dir)
+    for name, content in get_simulation_stubs(args.yum_delay, args.yum_package_delay, args.rpm_size * 1024).items():
+        with open(os.path.join(stub_dir, name), 'w') as f:
+            f.write(content)
+        os.chmod(os.path.join(stub_dir, name), 0o755)
+
+    # YUM镜像指向模拟的仓库，其他镜像不使用
+    mirrors = { kind : [] for kind in MirrorDefs.__members__ }
+    mirrors.update({ MirrorDefs.yum.name : [ Mirror(name = 'sim', kind = MirrorDefs.yum.name, url = f'{hub_url}/sim/sim.repo') ] })
+
+    results = []
+    try:
+        for i, mode in enumerate(args.mode or [ '' ]):
+            mode_args = mode_parser.parse_args(shlex.split(mode))
+            mode_args.internal_hub = hub_url
+            cache_dir, context_dir = os.path.join(workdir, 'caches', str(i)), os.path.join(workdir, 'context', str(i))
+
+            for run in range(args.runs):
+                coder = create_coder(mode_args, groups, mirrors)
+                sent_bytes, begin = hub.sent_bytes, time.monotonic()
+
+                if mode_args.prefetch or mode_args.prefetch_dir:
+                    # --prefetch每次构建都重新下载，--prefetch-dir保留下载的文件
+                    if not mode_args.prefetch_dir:
+                        shutil.rmtree(os.path.join(context_dir, 'prefetch'), ignore_errors = True)
+                    tasks = get_prefetch_tasks(coder, os.path.join(context_dir, 'prefetch'))
+                    coder.use_prefetched({ name : os.path.basename(filepath) for name, (url, filepath, sha256) in tasks.items() })
+                    prefetch_artifacts(tasks, mode_args.prefetch_workers)
+                prefetch_time = time.monotonic() - begin
+
+                result = simulate_build(coder, workdir, stub_dir, cache_dir, context_dir)
+                result.update(mode = mode or 'default', run = run + 1, prefetch = round(prefetch_time, 2), bytes = hub.sent_bytes - sent_bytes)
+                results.append(result)
+
+                failed = [ f for f in result.get('fragments') if f.get('status') ]
+                print(f'[{result.get("mode")}] #{run + 1}: {result.get("wall") + result.get("prefetch"):.2f}s{" (failed: " + ", ".join([ f.get("name") for f in failed ]) + ")" if failed else ""}')
+                for f in failed:
+                    with open(f.get('log')) as log:
+                        print(''.join(log.readlines()[-10:]))
+    finally:
+        if args.keep:
+            print(f'Simulation files: {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2, ensure_ascii = False)
+
+    mb = lambda n: n / 1024 / 1024
+    width = max([ len(r.get('mode')) for r in results ] + [ 4 ])
+    print(f'{"mode":<{width}}{"run":>4}{"wall":>9}{"prefetch":>10}{"fetched":>11}{"disk peak":>12}{"disk final":>12}')
+    for r in results:
+        print(f'{r.get("mode"):<{width}}{r.get("run"):>4}{r.get("wall"):>8.2f}s{r.get("prefetch"):>9.2f}s{mb(r.get("bytes")):>9.1f}MB{mb(r.get("disk_peak")):>10.1f}MB{mb(r.get("disk_final")):>10.1f}MB')
+
+    # 每个软件包在各次构建中的耗时
+    for mode in dict.fromkeys([ r.get('mode') for r in results ]):
+        runs = [ r for r in results if mode == r.get('mode') ]
+        print(f'\n[{mode}]')
+        names = list(dict.fromkeys([ f'{s.get("kind")} {s.get("name")}' for r in runs for s in r.get('steps') if s.get('kind') in (StepDefs.package.name, StepDefs.yum.name) ]))
+        for name in names:
+            durations = [ ([ s.get('duration') for s in r.get('steps') if f'{s.get("kind")} {s.get("name")}' == name ] + [ None ])[0] for r in runs ]
+            print(f'  {name:<24}' + ''.join([ f'{"-":>9}' if d is None else f'{d:>8.2f}s' for d in durations ]))
+
+    return 0 if all([ not f.get('status') for r in results for f in r.get('fragments') ]) else 1
+
+def run_script(args):
+    coder = ShCoder(None, *(get_variant_groups(args.variant) if args.variant else [ e for e in GroupDefs.__members__ ]))
+    coder.load_configuration(PKG_INFO_STR)
 
+    content = coder.get_run_script_content(args.image)
+    if not args.output:
+        print(content)
+        return 0
+
+    with open(args.output, 'w') as f:
+        f.write(content + '\n')
+    os.chmod(args.output, 0o755)
+    print(f'Run script: {args.output}')
+    for name, path in coder.get_volumes():
+        print(f'{name:<24} {path}')
+    return 0
+
+def probe(args):
+    mirrors = load_mirrors(args.mirrors_file)
+    ranking = get_mirror_ranking(mirrors, ranking_file = args.mirrors_ranking, ttl = args.mirrors_ttl, refresh = args.refresh, timeout = args.timeout, rounds = args.rounds)
+
+    for kind, items in ranking.items():
+        print(f'{kind}:')
+        for i, item in enumerate(items):
+            print(f'  {i + 1}. {item.get("name"):<20}{item.get("latency") * 1000:>8.0f}ms')
+    return 0
+
+def add_build_arguments(parser):
+    parser.add_argument('--internal-hub', default = None, help = '内部软件仓库地址')
+    parser.add_argument('--layered', action = 'store_true', help = '按组分层构建，未变化的组复用Docker缓存')
+    parser.add_argument('--multistage', action = 'store_true', help = '多阶段构建，每个语言组单独编译，最终镜像只复制安装目录')
+    parser.add_argument('--target', default = None, help = '多阶段构建的目标：语言组名称构建单个语言的镜像，默认包含所有语言')
+    parser.add_argument('--no-cache', action = 'store_true', help = '不使用Docker构建缓存')
+    parser.add_argument('--download-cache', action = 'store_true', help = '使用BuildKit缓存挂载在多次构建之间保留下载的软件包')
+    parser.add_argument('--download-cache-size', type = int, default = 2048, help = '下载缓存的大小上限（MB），超出时按LRU淘汰')
+    parser.add_argument('--yum-batch', choices = [ e for e in YumBatchDefs.__members__ ], default = None, help = '按组或全部合并YUM安装事务')
+    parser.add_argument('--yum-cache', action = 'store_true', help = '使用BuildKit缓存挂载在多次构建之间保留YUM元数据和RPM包，不写入镜像')
+    parser.add_argument('-j', '--jobs', type = int, default = None, help = '源码编译的并行任务数，默认为构建环境的CPU数量')
+    parser.add_argument('--ccache', action = 'store_true', help = '源码编译使用ccache，缓存目录在多次构建之间保留')
+    parser.add_argument('--ccache-size', type = int, default = 5, help = 'ccache缓存的大小上限（GB）')
+    parser.add_argument('--artifact-cache', action = 'store_true', help = '缓存源码编译的安装目录，配置不变时直接解压而不重新编译')
+    parser.add_argument('--artifact-cache-size', type = int, default = 4096, help = '编译产物缓存的大小上限（MB），超出时按LRU淘汰')
+    parser.add_argument('--dependency-cache', action = 'store_true', help = '预装配置项preload中的语言依赖时使用BuildKit缓存挂载，作为本地的wheelhouse、Maven仓库、Go模块和npm缓存')
+    parser.add_argument('--declare-volumes', action = 'store_true', help = '将依赖缓存目录（配置项volumes）声明为VOLUME，默认只记录在标签中')
+    parser.add_argument('--compression', choices = [ 'gzip', 'zstd' ], default = None, help = '使用buildx构建，镜像层按指定的格式压缩；zstd解压比gzip快，拉取和加载镜像更快')
+    parser.add_argument('--compression-level', type = int, default = None, help = '镜像层的压缩级别')
+    parser.add_argument('--export', default = None, help = '导出OCI格式的镜像文件，不加载到本地的Docker中，{tag}替换为镜像标签，如langs-{tag}.tar')
+    parser.add_argument('--locale', action = 'append', default = None, help = '生成的区域设置，可以指定多次，第一个为默认的语言环境，默认为zh_CN.UTF-8和en_US.UTF-8')
+    parser.add_argument('--stream', action = 'store_true', help = '下载的同时解压，不保存压缩包（zip和rpm除外）')
+    parser.add_argument('-v', '--verbose', action = 'store_true', help = '解压时输出文件列表')
+    parser.add_argument('-p', '--parallel', type = int, default = None, help = '在编译脚本中并行安装软件包的最大任务数，按配置项requires等待依赖')
+    parser.add_argument('--prefetch', action = 'store_true', help = '构建前在宿主机上并发下载软件包到构建上下文中')
+    parser.add_argument('--prefetch-dir', default = None, help = '保留预下载软件包的目录，支持断点续传和离线构建')
+    parser.add_argument('--prefetch-workers', type = int, default = 8, help = '并发下载的数量')
+    parser.add_argument('--slim', action = 'store_true', help = '安装后精简软件包（删除配置项slim匹配的文件、去除符号表），并记录每个软件包的大小')
+    parser.add_argument('--entrypoint', choices = [ e for e in EntrypointDefs.__members__ ], default = EntrypointDefs.systemd.name, help = '镜像默认的入口：systemd或不启动systemd的轻量入口，两者都会安装')
+    parser.add_argument('--ldconfig', action = 'store_true', help = f'动态库目录写到{LD_SO_CONF_PATH}，不设置LD_LIBRARY_PATH')
+    parser.add_argument('--retries', type = int, default = 5, help = '下载失败时的重试次数，按指数退避并断点续传')
+    parser.add_argument('--force', action = 'store_true', help = '即使已有相同输入的镜像也重新构建')
+    parser.add_argument('--probe-mirrors', action = 'store_true', help = '构建前测速，每种类型只使用最快的镜像，排名在有效期内复用')
+    add_mirror_arguments(parser)
+    parser.add_argument('--mirrors-count', type = int, default = 2, help = '每种类型使用的镜像数量，PyPI、Maven、npm和rustup只使用最快的一个')
+
+def add_mirror_arguments(parser):
+    parser.add_argument('--mirrors-file', default = None, help = '候选镜像配置文件，格式同内置的MIRROR_INFO_STR，替换内置的候选镜像；未测速时使用其中标记了default的镜像')
+    parser.add_argument('--mirrors-ranking', default = MIRROR_RANKING_PATH, help = f'镜像排名的保存位置，默认为{MIRROR_RANKING_PATH}')
+    parser.add_argument('--mirrors-ttl', type = int, default = 86400, help = '镜像排名的有效期（秒）')
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'langs', description = '多语言容器开发环境编译脚本')
+    subparsers = parser.add_subparsers(dest = 'command')
+
+    build_parser = subparsers.add_parser('build', help = '编译镜像（默认命令）')
+    add_build_arguments(build_parser)
+    build_parser.add_argument('-t', '--tag', default = None, help = '镜像标签，默认为langs:latest')
+    build_parser.set_defaults(func = build)
+
+    matrix_parser = subparsers.add_parser('matrix', help = '并发构建多个组合的镜像')
+    matrix_parser.add_argument('variants', nargs = '+', help = '组合列表，如cpp+python java golang+rust')
+    add_build_arguments(matrix_parser)
+    matrix_parser.add_argument('-w', '--workers', type = int, default = 2, help = '同时构建的镜像数量')
+    matrix_parser.add_argument('--name', default = None, help = '镜像名称，标签为组合名称，默认为langs')
+    matrix_parser.set_defaults(func = matrix)
+
+    proxy_parser = subparsers.add_parser('proxy', help = '运行本地缓存的软件包代理，作为--internal-hub的地址')
+    proxy_parser.add_argument('-l', '--listen', default = '0.0.0.0:8000', help = '监听地址，默认为0.0.0.0:8000')
+    proxy_parser.add_argument('-d', '--cache-dir', default = os.path.expanduser('~/.cache/langs/proxy'), help = '缓存目录')
+    proxy_parser.add_argument('-s', '--cache-size', type = int, default = 20480, help = '缓存的大小上限（MB），超出时按LRU淘汰')
+    proxy_parser.add_argument('-u', '--upstream', action = 'append', help = '覆盖软件包的上游地址，格式为name=http://host')
+    proxy_parser.set_defaults(func = proxy)
+
+    profile_parser = subparsers.add_parser('profile', help = '读取镜像中的编译分析文件，按耗时输出热点步骤')
+    profile_parser.add_argument('image', nargs = '?', default = 'langs:latest', help = '镜像名称，默认为langs:latest')
+    profile_parser.add_argument('-f', '--file', default = None, help = '直接读取本地的编译分析文件')
+    profile_parser.add_argument('-o', '--output', default = None, help = '输出JSON格式的编译分析结果')
+    profile_parser.add_argument('-k', '--kind', action = 'append', choices = [ e for e in StepDefs.__members__ ], help = '只输出指定类型的步骤')
+    profile_parser.add_argument('-n', '--top', type = int, default = 20, help = '输出耗时最多的步骤数量')
+    profile_parser.set_defaults(func = profile)
+
+    sizes_parser = subparsers.add_parser('sizes', help = '读取镜像中的软件包大小统计，按组汇总，需使用--slim编译')
+    sizes_parser.add_argument('image', nargs = '?', default = 'langs:latest', help = '镜像名称，默认为langs:latest')
+    sizes_parser.add_argument('-f', '--file', default = None, help = '直接读取本地的大小统计文件')
+    sizes_parser.add_argument('-o', '--output', default = None, help = '输出JSON格式的统计结果，用于跟踪镜像大小的变化')
+    sizes_parser.set_defaults(func = sizes)
+
+    bench_parser = subparsers.add_parser('bench', help = '测量不同入口的容器冷启动耗时（启动到SSH可连接）')
+    bench_parser.add_argument('image', nargs = '?', default = 'langs:latest', help = '镜像名称，默认为langs:latest')
+    bench_parser.add_argument('-e', '--entrypoint', action = 'append', choices = [ e for e in EntrypointDefs.__members__ ], help = '测量的入口，默认为全部')
+    bench_parser.add_argument('-n', '--runs', type = int, default = 5, help = '每个入口的启动次数')
+    bench_parser.add_argument('--timeout', type = int, default = 60, help = '等待SSH可连接的超时时间（秒）')
+    bench_parser.add_argument('--run-arg', action = 'append', help = '传给docker run的额外参数，如--run-arg=--privileged')
+    bench_parser.add_argument('-o', '--output', default = None, help = '输出JSON格式的测量结果')
+    bench_parser.set_defaults(func = bench)
+
+    simulate_parser = subparsers.add_parser('simulate', help = '不使用Docker和网络，在沙箱中执行编译脚本，比较不同构建模式的耗时、下载量和磁盘用量')
+    simulate_parser.add_argument('-m', '--mode', action = 'append', help = '构建模式，为build命令的参数，可以指定多次；参数以-开头，需写成--mode=的形式，如--mode=--layered、--mode="-p 4 --yum-batch all"，默认为不带参数的构建')
+    simulate_parser.add_argument('--variant', default = None, help = '安装的组合，如cpp+python，默认为全部组')
+    simulate_parser.add_argument('-n', '--runs', type = int, default = 2, help = '每个模式的构建次数，缓存挂载在多次构建之间保留')
+    simulate_parser.add_argument('--latency', type = float, default = 50, help = '模拟仓库每个响应的延迟（毫秒）')
+    simulate_parser.add_argument('--bandwidth', type = int, default = 10240, help = '模拟仓库每个连接的带宽（KB/s），0为不限速')
+    simulate_parser.add_argument('--archive-size', type = int, default = 1024, help = '假软件包的大小（KB）')
+    simulate_parser.add_argument('--rpm-size', type = int, default = 1024, help = '每个YUM软件包写入的大小（KB）')
+    simulate_parser.add_argument('--yum-delay', type = float, default = 1, help = '每个YUM事务的耗时（秒）')
+    simulate_parser.add_argument('--yum-package-delay', type = float, default = 0.2, help = '每个YUM软件包的耗时（秒）')
+    simulate_parser.add_argument('--compile-delay', type = float, default = 2, help = '源码编译的耗时（秒）')
+    simulate_parser.add_argument('-o', '--output', default = None, help = '输出JSON格式的结果')
+    simulate_parser.add_argument('--keep', action = 'store_true', help = '保留沙箱的文件和日志')
+    simulate_parser.set_defaults(func = simulate)
+
+    run_script_parser = subparsers.add_parser('run-script', help = '生成启动容器的脚本，挂载同一台主机上共享的依赖缓存')
+    run_script_parser.add_argument('image', nargs = '?', default = 'langs:latest', help = '镜像名称，默认为langs:latest')
+    run_script_parser.add_argument('--variant', default = None, help = '镜像包含的组合，如cpp+python，默认为全部组')
+    run_script_parser.add_argument('-o', '--output', default = None, help = '保存的脚本文件，默认输出到标准输出')
+    run_script_parser.set_defaults(func = run_script)
+
+    probe_parser = subparsers.add_parser('probe', help = '并发测速候选镜像，保存排名供构建时使用')
+    add_mirror_arguments(probe_parser)
+    probe_parser.add_argument('--refresh', action = 'store_true', help = '忽略保存的排名，重新测速')
+    probe_parser.add_argument('--timeout', type = int, default = 5, help = '单次测速的超时时间（秒）')
+    probe_parser.add_argument('--rounds', type = int, default = 2, help = '每个镜像的测速次数，取最小值')
+    probe_parser.set_defaults(func = probe)
+
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0].startswith('-') and argv[0] not in ('-h', '--help'):
+        argv = ['build'] + list(argv)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        warnings.warn(e)
+        sys.exit(1)